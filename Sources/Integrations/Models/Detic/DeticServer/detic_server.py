@@ -10,34 +10,95 @@ print(f'Starting detic server ...')
 import argparse
 import multiprocessing as mp
 import os
+import sys
 import time
-import PIL
-import zmq, msgpack, io
 import importlib
-
-print(f'Importing detectron2 ...')
-
-from detectron2.config import get_cfg
-from detectron2.data import MetadataCatalog
-from detectron2.data.detection_utils import convert_PIL_to_numpy
-from detectron2.engine.defaults import DefaultPredictor
-from detectron2.utils.logger import setup_logger
-
-print(f'Importing CenterNet2 ...')
-
-from centernet.config import add_centernet_config
-
-print(f'Importing Detic ...')
-
-from detic.config import add_detic_config
-from detic.modeling.utils import reset_cls_test
-from detic.modeling.text.text_encoder import build_text_encoder
-from detic.predictor import BUILDIN_CLASSIFIER, BUILDIN_METADATA_PATH
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ModelServing'))
+from model_serving import ExecutionMode, InputTransform, ModelAdapter, ModelServer, add_server_arguments, get_config_files, load_cached, optimize_model, select_instances
+
+
+# Function for importing the model code, which is only needed by the processes running the model (not
+# by the front end of a worker pool), and of which the stand-in model only needs detectron2 (see --stand-in)
+def importModelCode(stand_in):
+    global get_cfg, MetadataCatalog, DefaultPredictor, Boxes, Instances, setup_logger
+    global add_centernet_config, add_detic_config, reset_cls_test, build_text_encoder, BUILDIN_CLASSIFIER, BUILDIN_METADATA_PATH
+
+    print(f'Importing detectron2 ...')
+
+    from detectron2.config import get_cfg
+    from detectron2.data import MetadataCatalog
+    from detectron2.engine.defaults import DefaultPredictor
+    from detectron2.structures import Boxes, Instances
+    from detectron2.utils.logger import setup_logger
+
+    if stand_in:
+        return
+
+    print(f'Importing CenterNet2 ...')
+
+    from centernet.config import add_centernet_config
+
+    print(f'Importing Detic ...')
+
+    from detic.config import add_detic_config
+    from detic.modeling.utils import reset_cls_test
+    from detic.modeling.text.text_encoder import build_text_encoder
+    from detic.predictor import BUILDIN_CLASSIFIER, BUILDIN_METADATA_PATH
+
+
+def cropInstances(instances, height, width):
+    """
+    Crops predictions output for a letterboxed image to the original image.
+
+    Args:
+        instances (Instances): the predictions.
+        height, width (int): the size of the original image.
+
+    Returns:
+        instances (Instances): the predictions, with their masks cropped and their boxes clipped to the image.
+    """
+    cropped = Instances((height, width))
+    for name, value in instances.get_fields().items():
+        if name == "pred_masks":
+            value = value[:, :height, :width]
+        elif name == "pred_boxes":
+            value = value.clone()
+            value.clip((height, width))
+        cropped.set(name, value)
+    return cropped
+
+
+# Function for bringing the predictions of an image back from the device: only the instances scoring above
+# the threshold (and only the top max_instances ones, if not 0) are copied, and only the fields used in the
+# results, once each, and the predictions for letterboxed images are cropped first
+def transferInstances(instances, crop=None, threshold=0, max_instances=0, masks=True):
+    indices = select_instances(instances.scores, threshold, max_instances)
+    if len(indices) != len(instances):
+        instances = instances[indices]
+    if crop is not None:
+        instances = cropInstances(instances, *crop)
+    predictions = {
+        "pred_boxes": instances.pred_boxes.tensor.to("cpu").numpy(),
+        "scores": instances.scores.to("cpu").numpy(),
+        "pred_classes": instances.pred_classes.to("cpu").numpy(),
+    }
+    if masks and instances.has("pred_masks"):
+        predictions["pred_masks"] = instances.pred_masks.to("cpu").numpy()
+    return predictions
 
 
 class Predictor(object):
-    def __init__(self, cfg, args):
+    def __init__(self, cfg, args, embedding_cache=None, input_transform=None, execution=None):
         self.text_encoder = None
+        self.embedding_cache = embedding_cache
+        if input_transform is None:
+            input_transform = InputTransform(cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST)
+        self.input_transform = input_transform
+        if execution is None:
+            execution = ExecutionMode(torch.device(cfg.MODEL.DEVICE).type)
+        self.execution = execution
         if args.vocabulary == 'custom':
             self.metadata = MetadataCatalog.get(args.custom_vocabulary)
             self.metadata.thing_classes = args.custom_vocabulary.split(',')
@@ -52,13 +113,21 @@ class Predictor(object):
 
         reset_cls_test(self.predictor.model, classifier, num_classes)
 
-    def get_clip_embeddings(self, vocabulary, prompt='a '):
+    def get_text_encoder(self):
+        # the text encoder is only built once texts need encoding, which they may not if they are all cached
         if self.text_encoder is None:
             self.text_encoder = build_text_encoder(pretrain=True)
             self.text_encoder.eval()
+        return self.text_encoder
 
+    def get_clip_embeddings(self, vocabulary, prompt='a '):
         texts = [prompt + x for x in vocabulary]
-        emb = self.text_encoder(texts).detach().permute(1, 0).contiguous().cpu()
+        if self.embedding_cache is None:
+            emb = self.get_text_encoder()(texts).detach().permute(1, 0).contiguous().cpu()
+        else:
+            # only encode the texts which are not in the cache
+            emb = self.embedding_cache.get(texts, lambda missing: self.get_text_encoder()(missing).detach().cpu())
+            emb = emb.permute(1, 0).contiguous()
         return emb
 
     def reset_classes(self, classes, prompt='a '):
@@ -69,7 +138,20 @@ class Predictor(object):
         # get new embeddings and reset the model
         classifier = self.get_clip_embeddings(self.metadata.thing_classes)
         reset_cls_test(self.predictor.model, classifier, num_classes)
-        
+
+    def get_vocabulary(self):
+        # the zero-shot classifier weights of the current vocabulary, on the device (as set by
+        # reset_cls_test, normalized and with the background column), shared by all the cascade stages
+        roi_heads = self.predictor.model.roi_heads
+        return {"zs_weight": roi_heads.box_predictor[0].cls_score.zs_weight, "num_classes": roi_heads.num_classes, "metadata": self.metadata}
+
+    def set_vocabulary(self, state):
+        roi_heads = self.predictor.model.roi_heads
+        roi_heads.num_classes = state["num_classes"]
+        for box_predictor in roi_heads.box_predictor:
+            box_predictor.cls_score.zs_weight = state["zs_weight"]
+        self.metadata = state["metadata"]
+
     def run_on_image(self, image):
         """
         Args:
@@ -81,6 +163,118 @@ class Predictor(object):
         """
         return self.predictor(image)
 
+    def prepare_image(self, image, scale=1.0):
+        """
+        Applies the model's input transforms to an image, ahead of running it through the model.
+
+        Args:
+            image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+            scale (float): factor by which to scale down the input size for this image.
+
+        Returns:
+            inputs (dict): the model inputs for the image.
+        """
+        if self.predictor.input_format == "RGB":
+            image = image[:, :, ::-1]
+        image, inputs = self.input_transform(image, scale)
+        inputs["image"] = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return inputs
+
+    def run_on_inputs(self, inputs):
+        """
+        Runs a batch of prepared images through the model in a single forward pass.
+
+        Args:
+            inputs (list[dict]): the model inputs for each image, as returned by prepare_image.
+
+        Returns:
+            predictions (list[dict]): the output of the model for each image.
+        """
+        with self.execution():
+            return self.predictor.model(inputs)
+
+    def run_on_images(self, images):
+        """
+        Runs a batch of images through the model in a single forward pass.
+
+        Args:
+            images (list[np.ndarray]): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            predictions (list[dict]): the output of the model for each image.
+        """
+        return self.run_on_inputs([self.prepare_image(image) for image in images])
+
+
+class StandInPredictor(object):
+    """
+    CPU stand-in for the Predictor, for benchmarking the serving code without the model: applies
+    the same kind of input transforms, then takes a fixed amount of time per forward pass and per
+    image, and predicts randomly placed instances (with full image masks, like the model).
+    """
+    def __init__(self, cost, frame_cost, num_instances, input_transform=None, reset_cost=0):
+        if input_transform is None:
+            input_transform = InputTransform(800, 1333)
+        self.input_transform = input_transform
+        self.cost = cost
+        self.frame_cost = frame_cost
+        self.num_instances = num_instances
+        self.reset_cost = reset_cost
+        self.num_classes = 1
+        self.generator = torch.Generator().manual_seed(0)
+
+    def reset_classes(self, classes):
+        time.sleep(self.reset_cost)
+        self.num_classes = max(1, len(classes))
+
+    def get_vocabulary(self):
+        return {"num_classes": self.num_classes}
+
+    def set_vocabulary(self, state):
+        self.num_classes = state["num_classes"]
+
+    def prepare_image(self, image, scale=1.0):
+        """
+        Args:
+            image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+            scale (float): factor by which to scale down the input size for this image.
+
+        Returns:
+            inputs (dict): the model inputs for the image.
+        """
+        image, inputs = self.input_transform(image, scale)
+        inputs["image"] = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return inputs
+
+    def run_on_inputs(self, inputs):
+        """
+        Args:
+            inputs (list[dict]): the model inputs for each image, as returned by prepare_image.
+
+        Returns:
+            predictions (list[dict]): the stand-in predictions for each image.
+        """
+        start_time = time.perf_counter()
+        predictions = [{"instances": self.predict(data["height"], data["width"])} for data in inputs]
+        remaining = self.cost + self.frame_cost * len(inputs) - (time.perf_counter() - start_time)
+        if remaining > 0:
+            time.sleep(remaining)
+        return predictions
+
+    def predict(self, height, width):
+        n = self.num_instances
+        corners = torch.rand(n, 2, 2, generator=self.generator) * torch.tensor([width, height])
+        boxes = torch.cat([corners.min(dim=1).values, corners.max(dim=1).values], dim=1)
+        masks = torch.zeros(n, height, width, dtype=torch.bool)
+        for mask, (x0, y0, x1, y1) in zip(masks, boxes.int().tolist()):
+            mask[y0:y1, x0:x1] = True
+        instances = Instances((height, width))
+        instances.pred_boxes = Boxes(boxes)
+        instances.scores = torch.rand(n, generator=self.generator) * 0.5 + 0.5
+        instances.pred_classes = torch.randint(self.num_classes, (n,), generator=self.generator)
+        instances.pred_masks = masks
+        return instances
+
 
 def setup_cfg(args):
     cfg = get_cfg()
@@ -101,6 +295,13 @@ def setup_cfg(args):
     return cfg
 
 
+# Function for getting the model config from the cache directory, where it is stored once set up from
+# the config files, as long as the arguments and the config files (including their base configs) do not change
+def getCachedConfig(args, cache_dir):
+    key = (sorted(vars(args).items()), get_config_files([args.config_file]))
+    return load_cached(cache_dir, 'cfg', key, lambda: setup_cfg(args))
+
+
 def get_parser():
     parser = argparse.ArgumentParser(description="Detectron2 demo for builtin configs")
     parser.add_argument(
@@ -150,42 +351,83 @@ def get_parser():
     return parser
 
 
-# Function for reading images over zmq
-def readImage():
-    global request_number
-    try:
-        print(f'Waiting for request {request_number} ...', end='')
-        [topic, payload] = input.recv_multipart()
-        print('Received.')
-        request_number = request_number + 1
-        receive_time = time.time()
-        print('-> ', end='')
-        message = msgpack.unpackb(payload, raw=True, strict_map_key=False)
-        imageBytes = message[b"message"][0]
-        classes = message[b"message"][1]
-        image = PIL.Image.open(io.BytesIO(bytearray(imageBytes)))
-        originatingTime = message[b"originatingTime"]
-        return (image, classes, originatingTime, receive_time)
-    except Exception as e:
-        print(f'Exception encountered: {e}')
-        return (0, 0, 0, 0)
-
-
-# Function for writing back the features
-def writeResults(results, originatingTime):
-    payload = {}
-    payload[u"originatingTime"] = originatingTime
-    payload[u"message"] = results
-    output.send_multipart([output_topic.encode(), msgpack.dumps(payload)])
-
-
-def getCmdArgs(classes):
+def get_server_parser():
+    parser = argparse.ArgumentParser(description="Detic server")
+    add_server_arguments(parser)
+    parser.add_argument(
+        "--min-score-threshold",
+        type=float,
+        help="Score threshold of the model itself, below which requests cannot lower their threshold "
+        "(defaults to --score-threshold)",
+    )
+    return parser
+
+
+class DeticAdapter(ModelAdapter):
+    """
+    Adapter of the Detic model (or of its stand-in, with --stand-in) for the serving core.
+    """
+    name = 'Detic'
+
+    def load(self):
+        global detic_base_path
+        importModelCode(self.args.stand_in)
+        if self.args.stand_in:
+            print(f'Running Detic server with a stand-in model')
+            self.input_transform = self.get_input_transform(800, 1333)
+            self.predictor = StandInPredictor(self.args.stand_in_cost / 1000, self.args.stand_in_frame_cost / 1000, self.args.stand_in_instances, self.input_transform,
+                                              self.args.stand_in_reset_cost / 1000)
+            return
+
+        detic_base_path = getDeticBasePath()
+        print(f'Running Detic server from {detic_base_path}')
+        os.chdir(detic_base_path)
+
+        # the model is built with a placeholder vocabulary, which the first frame replaces
+        cmd_args = getCmdArgs(['object'], self.args.min_score_threshold)
+        if self.args.device is not None:
+            cmd_args += ["MODEL.DEVICE", self.args.device]
+
+        args = get_parser().parse_args(cmd_args)
+        setup_logger(name="fvcore")
+        logger = setup_logger()
+        logger.info("Arguments: " + str(args))
+
+        cfg = getCachedConfig(args, self.args.cache_dir)
+        # the class name embeddings depend on the whole model config (including its weights)
+        self.embedding_cache = self.get_embedding_cache(cfg.dump())
+        self.input_transform = self.get_input_transform(cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST)
+        self.execution = ExecutionMode(torch.device(cfg.MODEL.DEVICE).type, self.args.inference_mode, self.args.precision)
+        self.predictor = Predictor(cfg, args, self.embedding_cache, self.input_transform, self.execution)
+        optimize_model(self.predictor.predictor.model, self.args.compile, self.args.channels_last, dynamic=not self.args.letterbox)
+
+    def prepare(self, pixels, order, scale=1.0):
+        return self.predictor.prepare_image(pixels if order == 'BGR' else pixels[:, :, ::-1], scale)
+
+    def reset_vocabulary(self, classes):
+        self.predictor.reset_classes(classes)
+
+    def get_vocabulary(self):
+        return self.predictor.get_vocabulary()
+
+    def set_vocabulary(self, state):
+        self.predictor.set_vocabulary(state)
+
+    def infer_batch(self, batch_inputs):
+        return self.predictor.run_on_inputs(batch_inputs)
+
+    def postprocess(self, prediction, inputs, options):
+        return transferInstances(prediction["instances"], inputs.get("crop"), options['threshold'], options['maxInstances'], options['outputs'] != 'boxes')
+
+
+def getCmdArgs(classes, min_score_threshold):
     return [
         "--config-file", os.path.join(detic_base_path, "configs/Detic_LCOCOI21k_CLIP_SwinB_896b32_4x_ft4x_max-size.yaml"), 
         "--input", "desk.jpg", 
         "--output", "out.jpg", 
         "--vocabulary", "custom", 
         "--custom_vocabulary", ','.join(classes),
+        "--confidence-threshold", str(min_score_threshold),
         "--opts", "MODEL.WEIGHTS", os.path.join(detic_base_path, "models/Detic_LCOCOI21k_CLIP_SwinB_896b32_4x_ft4x_max-size.pth")]
 
 
@@ -195,89 +437,9 @@ def getDeticBasePath():
 
 
 if __name__ == "__main__":
-    detic_base_path = getDeticBasePath()
-    print(f'Running Detic server from {detic_base_path}')
-    os.chdir(detic_base_path)
-
+    server_args = get_server_parser().parse_args()
     mp.set_start_method("spawn", force=True)
+    if server_args.min_score_threshold is None:
+        server_args.min_score_threshold = server_args.score_threshold
 
-    classes = ['rigatoni', 'sausage', 'onion', 'fennel bulb','paprika','garlic','tinned chopped tomatoes','tablespoon','oil','saute pan','lid','plate','wine','tomatoes','water','salt','sauce','pot','pasta']
-    cmd_args = getCmdArgs(classes)
-    
-    args = get_parser().parse_args(cmd_args)
-    setup_logger(name="fvcore")
-    logger = setup_logger()
-    logger.info("Arguments: " + str(args))
-
-    cfg = setup_cfg(args)
-
-    predictor = Predictor(cfg, args)
-
-    #"""
-    # Setting up the zmq connection
-    input_connection = "tcp://127.0.0.1:36000"
-    input_topic = u"images"
-    output_connection = "tcp://127.0.0.1:36001"
-    output_topic = u"predictions"
-    request_number = 0
-
-    print(f'  Input at:     {input_connection}/{input_topic}')
-    print(f'  Output at:    {output_connection}/{output_topic}')
-
-    # Setup the incoming and outgoing ZMQ connection
-    print('\nEstablishing Zmq connections ...')
-    input = zmq.Context().socket(zmq.SUB)
-    input.setsockopt_string(zmq.SUBSCRIBE, input_topic)
-    input.setsockopt(zmq.HEARTBEAT_IVL, 0)
-    input.setsockopt(zmq.HEARTBEAT_TIMEOUT, 0)
-    input.connect(input_connection)
-    output = zmq.Context().socket(zmq.PUB)
-    output.setsockopt(zmq.HEARTBEAT_IVL, 0)
-    output.setsockopt(zmq.HEARTBEAT_TIMEOUT, 0)
-    output.bind(output_connection)
-
-    print('Zmq connections established.')
-    
-    while True:
-
-        # read the image
-        image, new_classes, originatingTime, receive_time = readImage()
-        
-        if image==0:
-            print('Continuing')
-            continue
-        
-        # if the new set of classes is different, then update
-        new_classes = list(map(str.strip, map(str.lower, map(bytes.decode, new_classes))))        
-        if classes != new_classes:
-            print(f'Re-computing encodings based on {len(new_classes)} classes ...')
-            classes = new_classes
-            predictor.reset_classes(new_classes)
-
-        # convert the image to numpy
-        img = convert_PIL_to_numpy(image, "BGR")
-
-        # get the prediction
-        predictions = predictor.run_on_image(img)
-        results = {}
-        pred_boxes = predictions["instances"].pred_boxes.tensor.cpu().numpy()
-        results["pred_boxes"] = predictions["instances"].pred_boxes.tensor.cpu().numpy().reshape(-1).tolist()
-        results["pred_classes"] = predictions["instances"].pred_classes.cpu().numpy().tolist()
-        results["scores"] = predictions["instances"].scores.cpu().numpy().tolist()
-        results["pred_masks"] = [None] * len(pred_boxes)
-        for i in range(len(pred_boxes)):            
-            box = pred_boxes[i]
-            results["pred_masks"][i] = predictions["instances"].pred_masks[i][int(box[1]):int(box[3]), int(box[0]):int(box[2])].cpu().numpy().tolist()
-        if len(pred_boxes) > 0:
-            print(f'Detected {len(predictions["instances"])} instances')
-            for i in results["pred_classes"]:
-                print(f'- {classes[i]}')
-
-        # print it
-        print(time.time() - receive_time, end='')
-
-        # send it
-        writeResults(results, originatingTime)
-
-        print('.')
-    #"""
+    ModelServer(DeticAdapter(server_args), server_args).run()
@@ -0,0 +1,473 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+#
+# Replays images into a model server (detic_server.py, seem_server.py) as psi would, and
+# reports the throughput, latency, payload sizes and drops of the predictions it publishes
+# (or of its replies, with the router transport).
+
+import argparse
+import io
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import msgpack
+import numpy as np
+import zmq
+
+# psi originating times are expressed in 100ns ticks since 0001-01-01 (UTC)
+TICKS_PER_SECOND = 10000000
+UNIX_EPOCH_TICKS = 621355968000000000
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Replay benchmark for the model servers")
+    parser.add_argument(
+        "--images",
+        help="Directory of images to replay (by default, synthetic images are generated)",
+    )
+    parser.add_argument(
+        "--size",
+        default="640x480",
+        help="Size of the synthetic images, as WIDTHxHEIGHT",
+    )
+    parser.add_argument(
+        "--classes",
+        default="person,chair,table,cup,bottle,laptop",
+        help="Comma-separated list of classes sent with each image",
+    )
+    parser.add_argument(
+        "--vocabularies",
+        type=int,
+        default=1,
+        help="Number of vocabularies (orderings of the classes) which the frames request in turn, "
+        "as would interleaved clients with different classes",
+    )
+    parser.add_argument(
+        "--frames",
+        type=int,
+        default=200,
+        help="Number of frames to replay (the images are replayed in a loop)",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=10,
+        help="Number of initial frames excluded from the statistics",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Rate (in frames per second) at which the frames are sent, regardless of the server (open loop); "
+        "0 to send each frame as soon as fewer than --concurrency frames are awaiting their predictions (closed loop)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of frames awaiting their predictions, when replaying in a closed loop",
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Send the images as raw RGB_24bpp frames rather than encoded image bytes",
+    )
+    parser.add_argument(
+        "--format",
+        help="Output format requested with each frame (by default, the server default)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        help="Input scale requested with each frame, to run the model at a lower resolution "
+        "(by default, the server input size)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Score threshold requested with each frame (by default, the server default)",
+    )
+    parser.add_argument(
+        "--max-instances",
+        type=int,
+        help="Maximum number of instances requested with each frame (by default, the server default)",
+    )
+    parser.add_argument(
+        "--outputs",
+        help="Outputs requested with each frame, e.g. 'boxes' (by default, the server default)",
+    )
+    parser.add_argument(
+        "--input",
+        default="tcp://127.0.0.1:36000",
+        help="Address at which the images are published, for the server to connect to",
+    )
+    parser.add_argument(
+        "--output",
+        default="tcp://127.0.0.1:36001",
+        help="Address of the server output, at which the predictions are collected",
+    )
+    parser.add_argument(
+        "--request",
+        help="Address of the request port of a server with the router transport (e.g. tcp://127.0.0.1:36002), "
+        "to which the frames are sent as requests rather than published",
+    )
+    parser.add_argument(
+        "--input-topic",
+        default="images",
+        help="Topic on which the images are published (see the server's --input-topic)",
+    )
+    parser.add_argument(
+        "--output-topic",
+        default="predictions",
+        help="Topic on which the server publishes the predictions (see the server's --output-topic)",
+    )
+    parser.add_argument(
+        "--drops-topic",
+        default="dropped",
+        help="Topic on which the server reports dropped frames",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Address of the server metrics socket (e.g. tcp://127.0.0.1:36200), queried at the end of the run",
+    )
+    parser.add_argument(
+        "--launch",
+        help="Command line of the server to start for the run (e.g. \"python detic_server.py --stand-in\"), "
+        "stopped at the end of the run",
+    )
+    parser.add_argument(
+        "--startup-timeout",
+        type=float,
+        default=300,
+        help="Time (in seconds) to wait for the server to publish its first predictions",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=10,
+        help="Time (in seconds) to wait for the predictions of the last frames",
+    )
+    parser.add_argument(
+        "--report",
+        help="File in which the report is also written, as JSON",
+    )
+    return parser
+
+
+# Function for loading the images to replay, as encoded image bytes (or raw frames)
+def loadImages(args):
+    from PIL import Image
+    images = []
+    if args.images is not None:
+        for name in sorted(os.listdir(args.images)):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                with open(os.path.join(args.images, name), 'rb') as f:
+                    images.append(f.read())
+        if len(images) == 0:
+            sys.exit(f'No images found in {args.images}')
+    else:
+        # synthetic scenes: a gradient background with a few rectangles
+        width, height = map(int, args.size.split('x'))
+        generator = np.random.default_rng(0)
+        for _ in range(8):
+            pixels = np.zeros((height, width, 3), dtype=np.uint8)
+            pixels[:] = np.linspace(0, 255, width, dtype=np.uint8)[None, :, None]
+            for _ in range(5):
+                x0, x1 = sorted(generator.integers(0, width, 2))
+                y0, y1 = sorted(generator.integers(0, height, 2))
+                pixels[y0:y1, x0:x1] = generator.integers(0, 256, 3)
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+            images.append(buffer.getvalue())
+    if args.raw:
+        frames = []
+        for imageBytes in images:
+            pixels = np.asarray(Image.open(io.BytesIO(imageBytes)).convert('RGB'))
+            frames.append({u"width": pixels.shape[1], u"height": pixels.shape[0], u"stride": pixels.shape[1] * 3,
+                           u"format": u"RGB_24bpp", u"data": pixels.tobytes()})
+        return frames
+    return images
+
+
+# Function for computing the count, mean, percentiles and maximum of a list of values
+def summarize(values, scale=1):
+    if len(values) == 0:
+        return {u"count": 0}
+    values = np.array(values) * scale
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {u"count": len(values), u"mean": float(values.mean()), u"p50": float(p50), u"p95": float(p95),
+            u"p99": float(p99), u"max": float(values.max())}
+
+
+# Collects the predictions and drop reports published by the server
+class Collector(object):
+    def __init__(self, context, args):
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, args.output_topic.encode())
+        self.socket.setsockopt(zmq.SUBSCRIBE, args.drops_topic.encode())
+        self.socket.connect(args.output)
+        self.input_topic = args.input_topic.encode()
+        self.output_topic = args.output_topic.encode()
+        self.drops_topic = args.drops_topic.encode()
+        self.lock = threading.Condition()
+        self.sent = {} # originating time -> (send time, request size) of the frames awaiting their predictions
+        self.results = [] # (originating time, latency, payload size, number of instances, receive time)
+        self.dropped = []
+        self.busy = []
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped:
+            if not self.socket.poll(100):
+                continue
+            topic, payload = self.socket.recv_multipart()
+            receive_time = time.perf_counter()
+            message = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+            with self.lock:
+                if topic == self.drops_topic:
+                    for originatingTime in message["message"]["originatingTimes"]:
+                        if self.sent.pop(originatingTime, None) is not None:
+                            self.dropped.append(originatingTime)
+                elif topic == self.output_topic: # (subscriptions match topic prefixes)
+                    originatingTime = message["originatingTime"]
+                    sent = self.sent.pop(originatingTime, None)
+                    if sent is not None:
+                        instances = len(message["message"].get("pred_classes", []))
+                        self.results.append((originatingTime, receive_time - sent[0], len(payload), instances, receive_time))
+                self.lock.notify_all()
+
+    def send(self, output, originatingTime, payload):
+        with self.lock:
+            self.sent[originatingTime] = (time.perf_counter(), len(payload))
+        output.send_multipart([self.input_topic, payload])
+
+    # waits until fewer than the given number of frames are awaiting their predictions
+    def waitPending(self, count, timeout=None):
+        with self.lock:
+            return self.lock.wait_for(lambda: len(self.sent) < count, timeout)
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+
+
+# Sends the frames as requests to a server with the router transport, and collects its replies. The
+# originating time of each frame is its correlation ID, and the requests are sent over the socket of
+# the collecting thread, through an inproc socket.
+class Requester(Collector):
+    def __init__(self, context, args):
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.connect(args.request)
+        self.requests = context.socket(zmq.PAIR)
+        self.requests.bind('inproc://requests')
+        self.sender = context.socket(zmq.PAIR)
+        self.sender.connect('inproc://requests')
+        self.lock = threading.Condition()
+        self.sent = {}
+        self.results = []
+        self.dropped = []
+        self.busy = []
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.requests, zmq.POLLIN)
+        while not self.stopped:
+            events = dict(poller.poll(100))
+            if self.requests in events:
+                self.socket.send_multipart(self.requests.recv_multipart())
+            if self.socket not in events:
+                continue
+            correlation_id, header, payload = self.socket.recv_multipart()
+            receive_time = time.perf_counter()
+            header = msgpack.unpackb(header, raw=False)
+            originatingTime = int.from_bytes(correlation_id, 'little')
+            with self.lock:
+                sent = self.sent.pop(originatingTime, None)
+                if sent is not None:
+                    if header["status"] == "ok":
+                        message = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+                        instances = len(message["message"].get("pred_classes", []))
+                        self.results.append((originatingTime, receive_time - sent[0], len(payload), instances, receive_time))
+                    elif header["status"] == "busy":
+                        self.busy.append(originatingTime)
+                    else:
+                        self.dropped.append(originatingTime)
+                self.lock.notify_all()
+
+    def send(self, output, originatingTime, payload):
+        with self.lock:
+            self.sent[originatingTime] = (time.perf_counter(), len(payload))
+        self.sender.send_multipart([originatingTime.to_bytes(8, 'little'), payload])
+
+
+# Function for making a psi message out of an image
+def makeMessage(image, classes, options, originatingTime):
+    message = [image, classes]
+    if len(options) > 0:
+        message.append(options)
+    return msgpack.dumps({u"message": message, u"originatingTime": originatingTime})
+
+
+# Function for getting the current time as a psi originating time, strictly after the previous one
+def nextOriginatingTime(previous):
+    return max(previous + 1, int(time.time() * TICKS_PER_SECOND) + UNIX_EPOCH_TICKS)
+
+
+def queryMetrics(context, address):
+    metrics = context.socket(zmq.REQ)
+    metrics.setsockopt(zmq.LINGER, 0)
+    metrics.connect(address)
+    metrics.send(b'metrics')
+    if not metrics.poll(5000):
+        return None
+    return msgpack.unpackb(metrics.recv(), raw=False, strict_map_key=False)
+
+
+def printReport(report):
+    if report["sent"] == 0:
+        print('Frames:       no frames measured (see --frames and --warmup)')
+    else:
+        printFrames(report)
+    if "server" in report:
+        print('Server stages:')
+        for name, stage in report["server"]["stages"].items():
+            print(f'  {name:<12}{stage["count"]} frames, avg {stage["mean"]:.1f} ms, p50 {stage["p50"]:.1f} ms, p95 {stage["p95"]:.1f} ms, p99 {stage["p99"]:.1f} ms, max {stage["max"]:.1f} ms')
+
+
+def printFrames(report):
+    print(f'Frames:       {report["sent"]} sent, {report["received"]} received, {report["dropped"]} dropped, {report["busy"]} busy, {report["lost"]} lost')
+    print(f'Throughput:   {report["fps"]:.2f} frames/s over {report["elapsed"]:.2f} s')
+    latency = report["latency"]
+    if latency["count"] > 0:
+        print(f'Latency:      avg {latency["mean"]:.1f} ms, p50 {latency["p50"]:.1f} ms, p95 {latency["p95"]:.1f} ms, p99 {latency["p99"]:.1f} ms, max {latency["max"]:.1f} ms')
+    print(f'Request size: avg {report["requestSize"]["mean"] / 1024:.1f} KB')
+    if report["resultSize"]["count"] > 0:
+        print(f'Result size:  avg {report["resultSize"]["mean"] / 1024:.1f} KB, max {report["resultSize"]["max"] / 1024:.1f} KB ({report["instances"]:.1f} instances per frame)')
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    classes = [c.strip() for c in args.classes.split(',') if c.strip() != '']
+    vocabularies = [classes[k % len(classes):] + classes[:k % len(classes)] for k in range(max(1, args.vocabularies))] if len(classes) > 0 else [classes]
+    options = {u"format": args.format} if args.format is not None else {}
+    if args.scale is not None:
+        options[u"scale"] = args.scale
+    if args.threshold is not None:
+        options[u"threshold"] = args.threshold
+    if args.max_instances is not None:
+        options[u"maxInstances"] = args.max_instances
+    if args.outputs is not None:
+        options[u"outputs"] = args.outputs
+    images = loadImages(args)
+    print(f'Replaying {args.frames} frames from {len(images)} images ({"raw" if args.raw else "encoded"})')
+
+    server = None
+    if args.launch is not None:
+        server = subprocess.Popen(shlex.split(args.launch))
+
+    # the images are published on an XPUB socket, to know when the server has subscribed to them
+    # (or sent as requests, with the router transport)
+    context = zmq.Context()
+    if args.request is not None:
+        output = None
+        collector = Requester(context, args)
+    else:
+        output = context.socket(zmq.XPUB)
+        output.setsockopt(zmq.SNDHWM, 0)
+        output.bind(args.input)
+        collector = Collector(context, args)
+    originatingTime = 0
+    metrics = None
+    try:
+        # wait for the server to subscribe, and to publish the predictions of a first frame (probing
+        # again every second, as the first predictions can be published before the collector is connected)
+        print('Waiting for the server ...')
+        if output is not None:
+            if not output.poll(args.startup_timeout * 1000):
+                sys.exit('The server did not connect.')
+            output.recv()
+        deadline = time.time() + args.startup_timeout
+        while True:
+            originatingTime = nextOriginatingTime(originatingTime)
+            collector.send(output, originatingTime, makeMessage(images[0], classes, options, originatingTime))
+            with collector.lock:
+                if collector.lock.wait_for(lambda: len(collector.results) > 0, min(1, max(0, deadline - time.time()))):
+                    break
+            if time.time() >= deadline:
+                sys.exit('The server did not publish any predictions.')
+        if output is None:
+            collector.waitPending(1, args.drain_timeout) # the earlier probes still count as in flight for the server
+        with collector.lock:
+            collector.sent.clear()
+            collector.results.clear()
+            collector.dropped.clear()
+            collector.busy.clear()
+
+        # replay the frames, either at a fixed rate or as the server completes them
+        print('Replaying ...')
+        warmup = min(args.warmup, args.frames - 1)
+        request_sizes = []
+        measured = set()
+        measure_time = None # time at which the first measured frame was sent (None if every frame is a warm-up frame)
+        start_time = time.perf_counter()
+        for i in range(args.frames):
+            if args.rate > 0:
+                delay = start_time + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                collector.waitPending(max(1, args.concurrency))
+            originatingTime = nextOriginatingTime(originatingTime)
+            payload = makeMessage(images[i % len(images)], vocabularies[i % len(vocabularies)], options, originatingTime)
+            if i == warmup:
+                measure_time = time.perf_counter()
+            if i >= warmup:
+                measured.add(originatingTime)
+                request_sizes.append(len(payload))
+            collector.send(output, originatingTime, payload)
+
+        # wait for the last predictions (the frames which are neither answered nor reported as dropped are lost)
+        collector.waitPending(1, args.drain_timeout)
+        collector.stop()
+        if args.metrics is not None:
+            metrics = queryMetrics(context, args.metrics)
+    finally:
+        if server is not None:
+            server.terminate()
+
+    results = [r for r in collector.results if r[0] in measured]
+    dropped = [t for t in collector.dropped if t in measured]
+    busy = [t for t in collector.busy if t in measured]
+    end_time = max(r[4] for r in results) if len(results) > 0 else time.perf_counter()
+    elapsed = end_time - measure_time if measure_time is not None else 0
+    report = {
+        u"sent": len(measured),
+        u"received": len(results),
+        u"dropped": len(dropped),
+        u"busy": len(busy),
+        u"lost": len(measured) - len(results) - len(dropped) - len(busy),
+        u"elapsed": elapsed,
+        u"fps": len(results) / elapsed if elapsed > 0 else 0,
+        u"latency": summarize([r[1] for r in results], 1000),
+        u"requestSize": summarize(request_sizes),
+        u"resultSize": summarize([r[2] for r in results]),
+        u"instances": float(np.mean([r[3] for r in results])) if len(results) > 0 else 0,
+    }
+    if metrics is not None:
+        report[u"server"] = metrics
+    printReport(report)
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,53 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+"""
+Serving core shared by the model servers: a model server implements a ModelAdapter for its model,
+and runs it with a ModelServer, which receives, decodes and batches the frames, runs them through
+the model, and serializes and sends the results (see Readme.md).
+"""
+
+from .adapter import ModelAdapter
+from .caches import EmbeddingCache, ResultCache, VocabularyCache, get_config_files, get_key_hash, load_cached
+from .execution import COMPILE_MODES, PRECISIONS, ExecutionMode, optimize_model
+from .frames import PIXEL_FORMATS, FrameReader
+from .options import LOG_LEVELS, add_server_arguments, read_options
+from .results import OUTPUT_FORMATS, OUTPUTS, get_results, select_instances
+from .sequencer import OutputSequencer
+from .server import TICKS_PER_SECOND, UNIX_EPOCH_TICKS, ModelServer
+from .stats import StageStats
+from .transforms import RESIZE_METHODS, InputTransform, pin
+from .transport import BUSY_REASONS, TRANSPORTS
+
+__all__ = [
+    'ModelAdapter',
+    'ModelServer',
+    'OutputSequencer',
+    'add_server_arguments',
+    'read_options',
+    'EmbeddingCache',
+    'ResultCache',
+    'VocabularyCache',
+    'get_config_files',
+    'get_key_hash',
+    'load_cached',
+    'ExecutionMode',
+    'optimize_model',
+    'FrameReader',
+    'InputTransform',
+    'pin',
+    'StageStats',
+    'get_results',
+    'select_instances',
+    'BUSY_REASONS',
+    'COMPILE_MODES',
+    'LOG_LEVELS',
+    'OUTPUT_FORMATS',
+    'OUTPUTS',
+    'PIXEL_FORMATS',
+    'PRECISIONS',
+    'RESIZE_METHODS',
+    'TICKS_PER_SECOND',
+    'TRANSPORTS',
+    'UNIX_EPOCH_TICKS',
+]
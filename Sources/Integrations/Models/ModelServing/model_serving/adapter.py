@@ -0,0 +1,140 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import PIL.Image
+
+from .caches import EmbeddingCache, get_key_hash
+from .transforms import InputTransform
+
+
+class ModelAdapter(object):
+    """
+    Interface between a model and the serving core (see ModelServer), which each model server implements
+    for its model. The core calls load once, before serving (or in a background thread, with
+    --load-in-background). prepare is then called for each frame from the decode thread, while
+    reset_vocabulary, get_vocabulary, set_vocabulary, infer_batch and postprocess are only called
+    from the inference thread.
+
+    Args:
+        args (argparse.Namespace): the server arguments (see add_server_arguments), along with
+            the model specific ones.
+    """
+    # Name of the model, as shown in the server messages
+    name = 'model'
+
+    def __init__(self, args):
+        self.args = args
+        self.input_transform = None
+        self.execution = None
+        self.embedding_cache = None
+
+    def load(self):
+        """
+        Imports the model code and builds the model (or its stand-in, with --stand-in), along with
+        its input transform (see get_input_transform) and its execution mode.
+        """
+        raise NotImplementedError
+
+    def prepare(self, pixels, order, scale=1.0):
+        """
+        Applies the model's input transforms to an image, ahead of running it through the model.
+
+        Args:
+            pixels (np.ndarray): an image of shape (H, W, 3), which may be a read-only view of a raw or shared
+                memory frame, whose buffer may be reused once prepare returns: the inputs must not share its memory.
+            order (str): the order of the color channels of the image ('RGB' or 'BGR').
+            scale (float): factor by which to scale down the input size for this image.
+
+        Returns:
+            inputs (dict): the model inputs for the image, along with the "height" and "width" of the
+                image (and its "crop", when letterboxed), as returned by the input transform.
+        """
+        raise NotImplementedError
+
+    def reset_vocabulary(self, classes):
+        """
+        Args:
+            classes (list[str]): the classes which the model predicts from now on.
+        """
+        raise NotImplementedError
+
+    def get_vocabulary(self):
+        """
+        Returns the resident state of the current vocabulary (e.g. the classifier weights on the
+        device), for it to be swapped back in with set_vocabulary rather than re-computed, or None if
+        the model does not support it (the default), in which case each change of vocabulary resets it.
+
+        Returns:
+            state: the state of the vocabulary, whose tensors count towards the vocabulary cache memory.
+        """
+        return None
+
+    def set_vocabulary(self, state):
+        """
+        Args:
+            state: the state of a vocabulary, as returned by get_vocabulary, which the model predicts from now on.
+        """
+        raise NotImplementedError
+
+    def infer_batch(self, batch_inputs):
+        """
+        Runs a batch of prepared images through the model in a single forward pass.
+
+        Args:
+            batch_inputs (list[dict]): the model inputs for each image, as returned by prepare.
+
+        Returns:
+            predictions (list): the output of the model for each image (possibly still on the device).
+        """
+        raise NotImplementedError
+
+    def postprocess(self, prediction, inputs, options):
+        """
+        Brings the predictions of an image back from the device, for the results to be assembled on the CPU.
+
+        Args:
+            prediction: the output of the model for the image, as returned by infer_batch.
+            inputs (dict): the model inputs for the image, as returned by prepare.
+            options (dict): the options of the request (see read_options): only the instances scoring
+                above its "threshold" are kept, and only the top "maxInstances" ones (if not 0), and
+                their masks are left out when its "outputs" are "boxes".
+
+        Returns:
+            predictions (dict): the predictions in the coordinates of the original image, as numpy
+                arrays: "pred_boxes" (N, 4) in XYXY format, "scores" (N,), "pred_classes" (N,) and,
+                unless left out, "pred_masks" (N, H, W) of booleans.
+        """
+        raise NotImplementedError
+
+    def get_input_transform(self, min_size, max_size, resample=PIL.Image.BILINEAR):
+        """
+        Args:
+            min_size, max_size (int): the model's own input size, unless overridden by --min-size and --max-size.
+            resample (int): the PIL resampling filter with which the model was trained.
+
+        Returns:
+            input_transform (InputTransform): the input transform, as configured by the server arguments.
+        """
+        args = self.args
+        min_size = args.min_size if args.min_size is not None else min_size
+        max_size = args.max_size if args.max_size is not None else max_size
+        return InputTransform(min_size, max_size, args.resize, args.letterbox, resample)
+
+    def get_embedding_cache(self, model_key):
+        """
+        Args:
+            model_key (object): the values which identify the model encoding the class names (e.g. its
+                resolved config and weights), whose representation keys the embeddings.
+
+        Returns:
+            embedding_cache (EmbeddingCache): the cache of the class name embeddings, persisted to
+                --embedding-cache-file or to the cache directory, or None if disabled.
+        """
+        args = self.args
+        if args.embedding_cache_size <= 0:
+            return None
+        path = args.embedding_cache_file
+        if path is None and args.cache_dir is not None:
+            path = os.path.join(args.cache_dir, f'embeddings-{get_key_hash(model_key)}.pt')
+        return EmbeddingCache(args.embedding_cache_size, path, model_key)
@@ -0,0 +1,211 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import collections
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import msgpack
+import zmq
+
+from .sequencer import OutputSequencer
+from .transport import DROP_REASONS, TICKS_PER_SECOND, peek_originating_time, publish, reply_to_client, subscribe
+
+log = logging.getLogger(__name__)
+
+# Time (in seconds) given to the workers to exit once terminated, before they are killed
+WORKER_EXIT_TIMEOUT = 10
+
+
+class PoolDrops(object):
+    """
+    Drop reports of a worker pool: merges the reports of the workers with the frames dropped by the front
+    end itself, into reports of the running totals of the whole pool, published on the drops topic in
+    increasing originating time order (the drop reports are not held back behind the results).
+
+    Args:
+        output (zmq.Socket): the socket on which the reports are published.
+        topic (str): the drops topic.
+    """
+    def __init__(self, output, topic):
+        self.output = output
+        self.topic = topic.encode()
+        self.totals = {} # worker index (None for the front end) -> reason -> number of dropped frames
+        self.last_time = 0
+
+    def drop(self, originatingTimes, reason, count=None):
+        # reports frames dropped by the front end (count frames, of which the originating times may be unknown)
+        count = len(originatingTimes) if count is None else count
+        counts = self.totals.setdefault(None, {})
+        counts[reason] = counts.get(reason, 0) + count
+        self.publish(originatingTimes, count)
+
+    def forward(self, worker, payload, originatingTime):
+        # reports the frames dropped by a worker, as reported by the worker
+        drops = msgpack.unpackb(payload, raw=False)[u"message"]
+        self.totals[worker] = {reason: drops.get(reason, 0) for reason in DROP_REASONS}
+        self.publish(drops[u"originatingTimes"], drops[u"count"], originatingTime)
+
+    def publish(self, originatingTimes, count, originatingTime=None):
+        drops = {}
+        drops[u"count"] = count
+        drops[u"originatingTimes"] = list(originatingTimes)
+        for reason in DROP_REASONS:
+            drops[reason] = sum(counts.get(reason, 0) for counts in self.totals.values())
+        if originatingTime is None:
+            originatingTime = max(originatingTimes, default=0)
+        self.last_time = max(originatingTime, self.last_time + 1)
+        payload = {u"originatingTime": self.last_time, u"message": drops}
+        self.output.send_multipart([self.topic, msgpack.dumps(payload)])
+
+
+def run_broker(args):
+    """
+    Front end of the worker pool: starts the worker processes (as instances of the server script
+    with --worker-index), forwards the incoming frames to them as they request them, and publishes
+    their results in originating time order (see OutputSequencer), holding back the results which arrive
+    before those of earlier frames still in flight. The input policy and the staleness deadline are applied
+    to the frames waiting for a worker, as by the workers to their own queues (see ModelServer.queue_frame
+    and ModelServer.is_stale). With the router transport, the replies are forwarded as they come.
+
+    Args:
+        args (argparse.Namespace): the server arguments (see add_server_arguments).
+    """
+    # exit (through the finally clause below, which stops the workers) when terminated or interrupted,
+    # rather than leaving the workers running with their models loaded
+    def exit_on_signal(signum, frame):
+        raise SystemExit(128 + signum)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, exit_on_signal)
+
+    script = os.path.abspath(sys.argv[0])
+    devices = [d for d in args.devices.split(',') if d != '']
+    workers = []
+    try:
+        for i in range(args.workers):
+            worker_args = [sys.executable, script] + sys.argv[1:] + ['--worker-index', str(i)]
+            if len(devices) > 0:
+                worker_args += ['--device', devices[i % len(devices)]]
+            workers.append(subprocess.Popen(worker_args))
+
+        context = zmq.Context()
+        if args.transport == 'router':
+            input = context.socket(zmq.ROUTER)
+            input.bind(f'tcp://127.0.0.1:{args.request_port}')
+            drops = None
+        else:
+            input = subscribe(context, args.input_connection, args.input_topic)
+            output = publish(context, args.output_connection)
+            drops = PoolDrops(output, args.drops_topic)
+        tasks = context.socket(zmq.ROUTER)
+        tasks.bind(f'tcp://127.0.0.1:{args.broker_port}')
+        results = context.socket(zmq.PULL)
+        results.bind(f'tcp://127.0.0.1:{args.broker_port + 1}')
+        log.info(f'Front end started with {len(workers)} workers.')
+
+        poller = zmq.Poller()
+        poller.register(input, zmq.POLLIN)
+        poller.register(tasks, zmq.POLLIN)
+        poller.register(results, zmq.POLLIN)
+        requests = collections.deque() # workers waiting for a frame, once for each frame they requested
+        pending = collections.deque() # frames waiting for a worker
+        sequencer = OutputSequencer(args.reorder_timeout / 1000) # the frames being processed by the workers
+        client_requests = collections.Counter() # client identity -> number of requests in flight, with the router transport
+        last_received = None # (originating time, time) of the latest frame, with the pubsub transport
+
+        # the number of published frames kept waiting for a worker, beyond which the oldest are dropped (or with
+        # the 'all' policy, no more are received until one is taken by a worker)
+        if args.input_policy == 'latest':
+            max_pending = 1
+        elif args.input_policy == 'newest':
+            max_pending = max(1, args.input_depth)
+        else:
+            max_pending = max(1, args.queue_size)
+
+        def is_stale(originatingTime):
+            # checks whether a frame lags behind the stream time extrapolated from the latest received frame
+            if args.max_staleness <= 0 or last_received is None:
+                return False
+            expected_originatingTime = last_received[0] + (time.time() - last_received[1]) * TICKS_PER_SECOND
+            return expected_originatingTime - originatingTime > args.max_staleness / 1000 * TICKS_PER_SECOND
+
+        while True:
+            # with the 'all' policy, the published frames are left in the input socket while queue size frames wait
+            # for a worker (as the decode stage of a single server blocks), rather than dropped
+            blocked = args.transport == 'pubsub' and args.input_policy == 'all' and len(pending) >= max_pending
+            poller.modify(input, 0 if blocked else zmq.POLLIN)
+            events = dict(poller.poll(100))
+            if tasks in events:
+                frames = tasks.recv_multipart()
+                if frames[1] == b'ready':
+                    requests.append(frames[0])
+                else:
+                    # a reply of a worker, with the router transport (replies are forwarded as they come, without reordering)
+                    _, _, identity, correlation_id, status, reason, payload = frames
+                    reply_to_client(input, client_requests, args.max_in_flight, identity, correlation_id, status, reason, payload)
+            if input in events:
+                if args.transport == 'router':
+                    identity, correlation_id, payload = input.recv_multipart()
+                    client_requests[identity] += 1
+                    if client_requests[identity] > args.max_in_flight:
+                        reply_to_client(input, client_requests, args.max_in_flight, identity, correlation_id, b'busy', b'throttled', b'')
+                    elif len(pending) >= args.queue_size:
+                        # the whole pool is at capacity: the frames only wait here once every place of the
+                        # workers' decoded queues is taken (or requested), and queue size frames already wait
+                        reply_to_client(input, client_requests, args.max_in_flight, identity, correlation_id, b'busy', b'overloaded', b'')
+                    else:
+                        pending.append((args.input_topic.encode(), payload, None, [identity, correlation_id]))
+                else:
+                    topic, payload = input.recv_multipart()
+                    try:
+                        originatingTime = peek_originating_time(payload)
+                        if originatingTime is None:
+                            raise ValueError('the message has no originating time')
+                    except Exception as e:
+                        # the frame cannot be sequenced (nor read by the workers): it is reported as failed,
+                        # without its originating time, which is unknown
+                        log.warning(f'Failed to read a frame: {e}')
+                        drops.drop([], 'failed', 1)
+                        continue
+                    pending.append((topic, payload, originatingTime, []))
+                    if last_received is None or originatingTime > last_received[0]:
+                        last_received = (originatingTime, time.time())
+                    while len(pending) > max_pending:
+                        dropped = pending.popleft()
+                        drops.drop([dropped[2]], 'superseded')
+            while len(requests) > 0 and len(pending) > 0:
+                topic, payload, originatingTime, route = pending.popleft()
+                if originatingTime is not None and is_stale(originatingTime):
+                    drops.drop([originatingTime], 'stale')
+                    continue
+                tasks.send_multipart([requests.popleft(), topic, payload] + route)
+                if originatingTime is not None:
+                    sequencer.expect(originatingTime)
+            while results.poll(0):
+                topic, payload, header = results.recv_multipart()
+                originatingTime, completed, worker = msgpack.unpackb(header)
+                sequencer.complete(completed)
+                if drops is not None and topic == drops.topic:
+                    drops.forward(worker, payload, originatingTime)
+                else:
+                    sequencer.hold(originatingTime, [topic, payload])
+
+            # publish the messages which are not preceded by any frame still in flight
+            released, late = sequencer.release()
+            for _, frames in released:
+                output.send_multipart(frames)
+            if len(late) > 0:
+                drops.drop([originatingTime for originatingTime, _ in late], 'late')
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(WORKER_EXIT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                log.warning(f'Worker {worker.pid} did not exit, killing it.')
+                worker.kill()
+                worker.wait()
@@ -0,0 +1,286 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import numpy as np
+import torch
+
+log = logging.getLogger(__name__)
+
+
+class EmbeddingCache(object):
+    """
+    LRU cache of per-class text embeddings, optionally persisted to a file, so that a change
+    of vocabulary only needs to encode the class names which have not been seen before. The
+    embeddings depend on the model which encodes them, so the file records a hash of the model
+    key (see get_key_hash), and the embeddings of a file saved for another model are discarded.
+    """
+    def __init__(self, capacity, path=None, model_key=None):
+        self.capacity = capacity
+        self.path = path
+        self.model = get_key_hash(model_key)
+        self.embeddings = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            saved = torch.load(path)
+            if saved.keys() == {"model", "embeddings"} and saved["model"] == self.model:
+                self.embeddings.update(saved["embeddings"])
+                self.evict()
+            else:
+                log.warning(f'Discarding the embeddings of {path}, which were saved for another model')
+
+    def get(self, keys, compute):
+        """
+        Args:
+            keys (list[str]): the texts to get the embeddings for.
+            compute (callable): computes the embeddings of a list of texts, as a tensor of shape (N, D).
+
+        Returns:
+            embeddings (torch.Tensor): the embeddings of the texts, of shape (N, D).
+        """
+        missing = [key for key in dict.fromkeys(keys) if key not in self.embeddings]
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        if len(missing) > 0:
+            for key, embedding in zip(missing, compute(missing)):
+                self.embeddings[key] = embedding
+        embeddings = []
+        for key in keys:
+            self.embeddings.move_to_end(key)
+            embeddings.append(self.embeddings[key])
+        self.evict()
+        if len(missing) > 0 and self.path is not None:
+            self.save()
+        return torch.stack(embeddings)
+
+    def evict(self):
+        while len(self.embeddings) > self.capacity:
+            self.embeddings.popitem(last=False)
+
+    def save(self):
+        torch.save({"model": self.model, "embeddings": dict(self.embeddings)}, self.path + '.tmp')
+        os.replace(self.path + '.tmp', self.path)
+
+    def get_metrics(self):
+        return {u"size": len(self.embeddings), u"hits": self.hits, u"misses": self.misses}
+
+    def __str__(self):
+        return f'{"cache":<12}{len(self.embeddings)} embeddings, {self.hits} hits, {self.misses} misses'
+
+
+class VocabularyCache(object):
+    """
+    LRU cache of the resident classifier state of several vocabularies (e.g. requested by different
+    clients), keyed by a hash of their classes, so that switching between them swaps the state in
+    rather than re-computing it. The cache holds at most capacity vocabularies, whose state tensors
+    take at most max_memory bytes (on whichever device they are).
+    """
+    def __init__(self, capacity, max_memory):
+        self.capacity = capacity
+        self.max_memory = max_memory
+        self.vocabularies = collections.OrderedDict() # key -> (state, memory)
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(classes):
+        """
+        Returns:
+            key (str): the hash of a vocabulary, i.e. of its classes, in order.
+        """
+        return hashlib.sha1('\n'.join(classes).encode('utf-8')).hexdigest()
+
+    def get(self, classes):
+        """
+        Args:
+            classes (list[str]): the classes of the vocabulary.
+
+        Returns:
+            state: the resident state of the vocabulary, or None if it is not in the cache.
+        """
+        key = self.get_key(classes)
+        entry = self.vocabularies.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.vocabularies.move_to_end(key)
+        return entry[0]
+
+    def put(self, classes, state):
+        """
+        Args:
+            classes (list[str]): the classes of the vocabulary.
+            state: the resident state of the vocabulary, as returned by ModelAdapter.get_vocabulary.
+        """
+        memory = get_memory(state)
+        if memory > self.max_memory:
+            return
+        key = self.get_key(classes)
+        if key in self.vocabularies:
+            self.memory -= self.vocabularies.pop(key)[1]
+        self.vocabularies[key] = (state, memory)
+        self.memory += memory
+        while len(self.vocabularies) > self.capacity or self.memory > self.max_memory:
+            self.memory -= self.vocabularies.popitem(last=False)[1][1]
+
+    def get_metrics(self):
+        return {u"size": len(self.vocabularies), u"memory": self.memory, u"hits": self.hits, u"misses": self.misses}
+
+    def __str__(self):
+        return f'{"vocabulary":<12}{len(self.vocabularies)} resident ({self.memory / 2**20:.1f} MB), {self.hits} hits, {self.misses} misses'
+
+
+def get_memory(state):
+    # the memory taken by the tensors of a (possibly nested) state
+    if isinstance(state, torch.Tensor):
+        return state.numel() * state.element_size()
+    if isinstance(state, dict):
+        return sum(get_memory(value) for value in state.values())
+    if isinstance(state, (list, tuple)):
+        return sum(get_memory(value) for value in state)
+    return 0
+
+
+class ResultCache(object):
+    """
+    Cache of the results of the last processed frame, for frames which are nearly identical to it
+    (e.g. from a static camera) to re-use them instead of running the model again. Frames are compared
+    through signatures: grayscale thumbnails, whose mean absolute difference must be within threshold
+    (in gray levels), for frames requested with the same classes and options, and at most max_age
+    (in ticks) after the last processed frame.
+    """
+    def __init__(self, threshold, max_age, size=32):
+        self.threshold = threshold
+        self.max_age = max_age
+        self.size = size
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+        self.entry = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_signature(self, image):
+        """
+        Args:
+            image (np.ndarray): an image of shape (H, W, C).
+
+        Returns:
+            signature (np.ndarray): a grayscale thumbnail of the image, of shape (size, size).
+        """
+        height, width = image.shape[:2]
+        rows = np.linspace(0, height - 1, self.size).astype(np.intp)
+        columns = np.linspace(0, width - 1, self.size).astype(np.intp)
+        return image[rows[:, None], columns].mean(axis=-1, dtype=np.float32)
+
+    def lookup(self, signature, classes, options, originatingTime):
+        """
+        Args:
+            signature (np.ndarray): the signature of the frame.
+            classes (list[str]): the classes requested for the frame.
+            options (dict): the options requested for the frame.
+            originatingTime (int): the originating time of the frame.
+
+        Returns:
+            results (dict): the cached results, or None if they cannot be re-used for this frame, which
+                is then expected to be processed, and its results stored.
+        """
+        entry = self.entry
+        if entry is not None:
+            cached_signature, cached_classes, cached_options, results, cachedTime = entry
+            if cached_classes == classes and cached_options == options and 0 <= originatingTime - cachedTime <= self.max_age and \
+                    np.abs(cached_signature - signature).mean() <= self.threshold:
+                self.hits += 1
+                return results
+        self.misses += 1
+        with self.lock:
+            self.pending[originatingTime] = signature
+        return None
+
+    def store(self, classes, options, results, originatingTime):
+        with self.lock:
+            signature = None
+            while len(self.pending) > 0 and next(iter(self.pending)) <= originatingTime:
+                pendingTime, signature = self.pending.popitem(last=False)
+            if signature is not None and pendingTime == originatingTime:
+                self.entry = (signature, classes, options, results, originatingTime)
+
+    def get_metrics(self):
+        return {u"hits": self.hits, u"misses": self.misses}
+
+    def __str__(self):
+        count = self.hits + self.misses
+        return f'{"reuse":<12}{self.hits} hits, {self.misses} misses ({self.hits / max(1, count):.1%} hit rate)'
+
+
+def get_key_hash(key):
+    """
+    Returns a short hash of the representation of a key (e.g. the values an object is built from).
+    """
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def get_config_files(paths, base_key='_BASE_'):
+    """
+    Returns the modification times of config files, and of all the config files which they inherit from
+    (through their base_key entries, as in detectron2 configs, relative to the file), for the cached
+    objects built from the configs to be rebuilt when any file of the chain changes.
+
+    Args:
+        paths (list[str]): the config files.
+        base_key (str): the key of the base config file (or files) in a config file.
+
+    Returns:
+        files (list[tuple]): the (path, modification time) of each config file.
+    """
+    import yaml
+    files = []
+    pending = list(paths)
+    while len(pending) > 0:
+        path = os.path.abspath(pending.pop(0))
+        if any(path == f for f, _ in files):
+            continue
+        files.append((path, os.path.getmtime(path)))
+        with open(path, encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+        bases = config.get(base_key) if isinstance(config, dict) else None
+        if isinstance(bases, str):
+            bases = [bases]
+        for base in bases or []:
+            base = os.path.join(os.path.dirname(path), os.path.expanduser(base))
+            if os.path.exists(base): # (not for remote base configs)
+                pending.append(base)
+    return files
+
+
+def load_cached(cache_dir, name, key, build):
+    """
+    Gets an object from the cache directory, where it is pickled once built, for as long as its key does not change.
+
+    Args:
+        cache_dir (str): the cache directory, or None to always build the object.
+        name (str): the name of the object, which prefixes the name of its file.
+        key (object): the values the object is built from, whose representation identifies it.
+        build (callable): builds the object.
+
+    Returns:
+        value (object): the cached or newly built object.
+    """
+    if cache_dir is None:
+        return build()
+    path = os.path.join(cache_dir, f'{name}-{get_key_hash(key)}.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    value = build()
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(value, f)
+    os.replace(path + '.tmp', path)
+    return value
@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import contextlib
+import logging
+import os
+import torch
+
+# Precisions in which the model can run: in fp32, or with fp16 or bf16 autocast (mixed precision)
+PRECISIONS = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+# Modes in which the model backbone can be compiled with torch.compile
+COMPILE_MODES = ['off', 'default', 'reduce-overhead', 'max-autotune']
+
+log = logging.getLogger(__name__)
+
+
+class ExecutionMode(object):
+    """
+    Context in which the model runs: without autograd, under torch.inference_mode (which also skips
+    the version counting and view tracking of tensors) or torch.no_grad, and optionally under
+    autocast with fp16 or bf16, where the device supports it.
+    """
+    def __init__(self, device_type, inference_mode=False, precision='fp32'):
+        self.device_type = device_type
+        self.inference_mode = inference_mode
+        self.dtype = PRECISIONS[precision]
+        if self.dtype is not None and not self.is_supported(self.dtype):
+            log.warning(f'{precision} autocast is not supported on {device_type}, running in fp32')
+            self.dtype = None
+
+    def is_supported(self, dtype):
+        if self.device_type == 'cuda':
+            return torch.cuda.is_available() and (dtype != torch.bfloat16 or torch.cuda.is_bf16_supported())
+        return self.device_type == 'cpu' and dtype == torch.bfloat16
+
+    def __call__(self):
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode() if self.inference_mode else torch.no_grad())
+        if self.dtype is not None:
+            stack.enter_context(torch.autocast(self.device_type, dtype=self.dtype))
+        return stack
+
+    def __str__(self):
+        precision = next(name for name, dtype in PRECISIONS.items() if dtype == self.dtype)
+        return f'{precision} on {self.device_type}{", inference mode" if self.inference_mode else ""}'
+
+
+def optimize_model(model, compile_mode='off', channels_last=False, dynamic=True):
+    """
+    Optimizes a model for inference.
+
+    Args:
+        model (torch.nn.Module): the model, with a backbone attribute.
+        compile_mode (str): mode in which to compile the backbone with torch.compile ('off' to leave it as is).
+        channels_last (bool): whether to convert the model to the channels-last memory format.
+        dynamic (bool): whether the compiled backbone should expect inputs of varying sizes.
+    """
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if compile_mode != 'off':
+        model.backbone = torch.compile(model.backbone, mode=compile_mode, dynamic=dynamic)
+
+
+def load_compile_cache(path):
+    """
+    Restores the artifacts of a previous compilation of the model (with versions of torch which
+    support it), for torch.compile not to start from scratch.
+    """
+    if hasattr(torch.compiler, 'load_cache_artifacts') and os.path.exists(path):
+        with open(path, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+
+def save_compile_cache(path):
+    """
+    Saves the artifacts of the compilation of the model, for load_compile_cache to restore them.
+    """
+    artifacts = torch.compiler.save_cache_artifacts() if hasattr(torch.compiler, 'save_cache_artifacts') else None
+    if artifacts is not None:
+        with open(path + '.tmp', 'wb') as f:
+            f.write(artifacts[0])
+        os.replace(path + '.tmp', path)
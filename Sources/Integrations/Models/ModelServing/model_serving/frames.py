@@ -0,0 +1,91 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import io
+import warnings
+import numpy as np
+import PIL.Image
+from multiprocessing import shared_memory
+
+# Pixel formats of raw frames, named as in psi: bytes per pixel and order of the color channels
+PIXEL_FORMATS = {
+    'BGR_24bpp': (3, 'BGR'),
+    'BGRX_32bpp': (4, 'BGR'),
+    'BGRA_32bpp': (4, 'BGR'),
+    'RGB_24bpp': (3, 'RGB'),
+    'Gray_8bpp': (1, 'RGB'),
+}
+
+# Images are wrapped in place in the (read-only) message buffers, and only read from
+warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+
+
+class FrameReader(object):
+    """
+    Reads the images carried by the messages: either encoded image bytes (e.g. JPEG), which are
+    decoded, or raw frames, whose pixels are wrapped in place, either in the message or in a slot
+    of a shared memory ring buffer, without any intermediate copies.
+    """
+    def __init__(self):
+        self.shared_memories = {}
+
+    def open(self, image):
+        """
+        Args:
+            image (bytes or dict): the first element of a message: encoded image bytes, or a raw frame.
+
+        Returns:
+            image (PIL.Image.Image or tuple): the opened (but not yet decoded) image, or the pixels of
+                the raw frame, as returned by read_frame.
+        """
+        if isinstance(image, dict):
+            return self.read_frame(image)
+        return PIL.Image.open(io.BytesIO(image))
+
+    def decode(self, image):
+        """
+        Args:
+            image (PIL.Image.Image or tuple): an image, as returned by open.
+
+        Returns:
+            pixels (np.ndarray): the pixels of the image, of shape (H, W, 3).
+            order (str): the order of the color channels of the pixels ('RGB' or 'BGR').
+        """
+        if isinstance(image, tuple):
+            return image
+        return np.asarray(image if image.mode == 'RGB' else image.convert('RGB')), 'RGB'
+
+    def read_frame(self, frame):
+        """
+        Args:
+            frame (dict): a raw frame, with its pixels in "data" or in a slot of a shared memory segment.
+
+        Returns:
+            pixels (np.ndarray): a view of the pixels of the frame, of shape (H, W, 3).
+            order (str): the order of the color channels of the pixels ('RGB' or 'BGR').
+        """
+        width = frame[b"width"]
+        height = frame[b"height"]
+        stride = frame[b"stride"]
+        bytes_per_pixel, order = PIXEL_FORMATS[frame[b"format"].decode()]
+        if b"sharedMemory" in frame:
+            buffer = self.get_shared_memory(frame[b"sharedMemory"].decode()).buf
+            offset = frame[b"slot"] * frame[b"slotSize"]
+        else:
+            buffer = frame[b"data"]
+            offset = 0
+        pixels = np.ndarray((height, width, bytes_per_pixel), dtype=np.uint8, buffer=buffer, offset=offset, strides=(stride, bytes_per_pixel, 1))
+        if bytes_per_pixel == 1:
+            pixels = np.broadcast_to(pixels, (height, width, 3))
+        elif bytes_per_pixel == 4:
+            pixels = pixels[:, :, :3]
+        return pixels, order
+
+    def get_shared_memory(self, name):
+        # the segment is owned by the producer, and stays attached for the lifetime of the server
+        if name not in self.shared_memories:
+            try:
+                self.shared_memories[name] = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self.shared_memories[name] = shared_memory.SharedMemory(name=name)
+        return self.shared_memories[name]
@@ -0,0 +1,424 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import argparse
+import logging
+
+from .execution import COMPILE_MODES, PRECISIONS
+from .results import OUTPUT_FORMATS, OUTPUTS
+from .transforms import RESIZE_METHODS
+from .transport import TRANSPORTS
+
+# Levels of the server log messages: per-frame messages are logged at the debug level,
+# and the per-stage statistics at the info level
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'off': logging.CRITICAL + 1,
+}
+
+log = logging.getLogger(__name__)
+
+
+def get_option_names(name):
+    # options are accepted with dashes as well as with underscores (e.g. --batch-size or --batch_size)
+    return list(dict.fromkeys(['--' + name, '--' + name.replace('-', '_')]))
+
+
+def add_server_arguments(parser):
+    """
+    Adds the options of the serving core to the argument parser of a model server. The options
+    which depend on the model (e.g. --score-threshold) can be given other defaults with set_defaults.
+
+    Args:
+        parser (argparse.ArgumentParser): the argument parser of the model server.
+    """
+    def add(name, **kwargs):
+        parser.add_argument(*get_option_names(name), **kwargs)
+
+    add(
+        "input-connection",
+        default="tcp://127.0.0.1:36000",
+        help="Address of the psi publisher to which the server subscribes for frames, with the pubsub transport",
+    )
+    add(
+        "input-topic",
+        default="images",
+        help="Topic on which the frames are received",
+    )
+    add(
+        "output-connection",
+        default="tcp://127.0.0.1:36001",
+        help="Address at which the server publishes its results, with the pubsub transport",
+    )
+    add(
+        "output-topic",
+        default="predictions",
+        help="Topic on which the results are published",
+    )
+    add(
+        "batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of queued frames to run through the model in one forward pass",
+    )
+    add(
+        "batch-timeout",
+        type=float,
+        default=0,
+        help="Time (in milliseconds) to wait for additional frames to fill a batch",
+    )
+    add(
+        "queue-size",
+        type=int,
+        default=4,
+        help="Maximum number of frames waiting between the decode, inference and encode stages",
+    )
+    add(
+        "output-format",
+        default="lists",
+        choices=OUTPUT_FORMATS,
+        help="Format of the predictions, for requests which do not specify one",
+    )
+    add(
+        "score-threshold",
+        type=float,
+        default=0.5,
+        help="Minimum score of the returned instances, for requests which do not specify one",
+    )
+    add(
+        "max-instances",
+        type=int,
+        default=0,
+        help="Maximum number of (top-scoring) instances returned for each frame, for requests "
+        "which do not specify one (0 for no limit)",
+    )
+    add(
+        "outputs",
+        default="masks",
+        choices=OUTPUTS,
+        help="Outputs returned for each instance, for requests which do not specify them: "
+        "its mask and box, only its box, or the polygons outlining its mask and its box",
+    )
+    add(
+        "polygon-tolerance",
+        type=float,
+        default=1.0,
+        help="Maximum distance (in pixels) between the returned polygons and the outlines of the masks, "
+        "for requests which do not specify one (0 to keep every vertex)",
+    )
+    add(
+        "min-size",
+        type=int,
+        help="Size to which the short side of the images is resized for the model "
+        "(defaults to the model's own input size)",
+    )
+    add(
+        "max-size",
+        type=int,
+        help="Maximum size of the long side of the resized images (0 for no limit), and size of the square "
+        "in which they are letterboxed (defaults to the model's own input size)",
+    )
+    add(
+        "resize",
+        default="pil",
+        choices=RESIZE_METHODS,
+        help="Method for resizing the images: with PIL (as the model was trained), or fast "
+        "(with OpenCV if installed, with torch otherwise)",
+    )
+    add(
+        "letterbox",
+        action="store_true",
+        help="Resize the images to fit in a square of side --max-size and pad them to it, "
+        "for all the model inputs to have the same shape",
+    )
+    add(
+        "tile-size",
+        type=int,
+        default=0,
+        help="Split the images whose long side exceeds this size into overlapping square tiles of this size, "
+        "run through the model as a batch, and merge their predictions (0 to disable)",
+    )
+    add(
+        "tile-overlap",
+        type=int,
+        default=128,
+        help="Minimum overlap (in pixels) between neighboring tiles",
+    )
+    add(
+        "tile-iou-threshold",
+        type=float,
+        default=0.5,
+        help="Minimum overlap (intersection over union) of the instances of different tiles which are merged",
+    )
+    add(
+        "tile-memory",
+        type=float,
+        default=0,
+        help="Memory budget (in MB) of each forward pass: the tiles are run in as many forward passes as needed "
+        "to fit in it, as estimated from the memory measured after the warm-up on CUDA devices (0 for no limit)",
+    )
+    add(
+        "reuse-threshold",
+        type=float,
+        default=0,
+        help="Re-use the results of the last processed frame for frames which differ from it by at most "
+        "this mean absolute difference of their grayscale thumbnails, in gray levels (0 to disable)",
+    )
+    add(
+        "reuse-max-age",
+        type=float,
+        default=1000,
+        help="Maximum time (in milliseconds) for which the results of a processed frame are re-used",
+    )
+    add(
+        "embedding-cache-size",
+        type=int,
+        default=4096,
+        help="Maximum number of class name embeddings kept in the cache (0 to disable the cache)",
+    )
+    add(
+        "embedding-cache-file",
+        help="File in which the class name embeddings are persisted across runs (those saved for another model are discarded)",
+    )
+    add(
+        "vocabulary-cache-size",
+        type=int,
+        default=8,
+        help="Maximum number of vocabularies (lists of classes) whose classifier state is kept resident, "
+        "for switching between them without re-computing it (0 to disable)",
+    )
+    add(
+        "vocabulary-cache-memory",
+        type=float,
+        default=256,
+        help="Maximum memory (in MB) taken by the resident vocabularies",
+    )
+    add(
+        "input-policy",
+        default="all",
+        choices=['all', 'latest', 'newest'],
+        help="Delivery policy for incoming frames: process all of them, only the latest one, "
+        "or the newest --input-depth ones (older waiting frames are dropped)",
+    )
+    add(
+        "input-depth",
+        type=int,
+        default=2,
+        help="Number of waiting frames kept with the 'newest' input policy",
+    )
+    add(
+        "max-staleness",
+        type=float,
+        default=0,
+        help="Drop frames whose originating time lags behind the last processed frame "
+        "by more than this many milliseconds (0 to disable)",
+    )
+    add(
+        "drops-topic",
+        default="dropped",
+        help="Topic on which dropped frames are reported",
+    )
+    add(
+        "transport",
+        default="pubsub",
+        choices=TRANSPORTS,
+        help="Transport of the frames and results: subscribe to frames and publish results (pubsub), "
+        "or reply to each request of the clients connected to the request port (router)",
+    )
+    add(
+        "request-port",
+        type=int,
+        default=36002,
+        help="Port on which requests are received with the router transport",
+    )
+    add(
+        "max-in-flight",
+        type=int,
+        default=2,
+        help="Maximum number of requests of each client in flight with the router transport "
+        "(further requests get a busy reply)",
+    )
+    add(
+        "workers",
+        type=int,
+        default=0,
+        help="Number of worker processes, each with its own model, behind this process "
+        "acting as the front end (0 to run the model in this process)",
+    )
+    add(
+        "devices",
+        default="",
+        help="Comma-separated list of devices assigned to the workers in turn (e.g. 'cuda:0,cuda:1,cpu')",
+    )
+    add(
+        "device",
+        help="Device on which to run the model (by default, the model's own device)",
+    )
+    add(
+        "threads",
+        type=int,
+        default=0,
+        help="Number of threads used by torch within each operation on the CPU (0 for the torch default)",
+    )
+    add(
+        "inference-mode",
+        action="store_true",
+        help="Run the model under torch.inference_mode rather than torch.no_grad",
+    )
+    add(
+        "precision",
+        default="fp32",
+        choices=PRECISIONS,
+        help="Precision in which to run the model: fp32, or mixed precision with fp16 or bf16 autocast "
+        "(where supported by the device, otherwise fp32)",
+    )
+    add(
+        "compile",
+        default="off",
+        choices=COMPILE_MODES,
+        help="Mode in which to compile the model backbone with torch.compile",
+    )
+    add(
+        "channels-last",
+        action="store_true",
+        help="Convert the model to the channels-last memory format",
+    )
+    add(
+        "warmup",
+        type=int,
+        default=2,
+        help="Number of batches of images run through the model before serving, so that the first frames "
+        "do not pay for compiling the model or growing the allocator caches",
+    )
+    add(
+        "warmup-size",
+        default="640x480",
+        help="Size of the warm-up images, as WIDTHxHEIGHT",
+    )
+    add(
+        "broker-port",
+        type=int,
+        default=36100,
+        help="Port on which the front end dispatches frames to the workers (results are collected on the next port)",
+    )
+    add(
+        "reorder-timeout",
+        type=float,
+        default=5000,
+        help="Maximum time (in milliseconds) for which the results published on the output topic are held back "
+        "waiting for the results of earlier frames, after which those frames are skipped (and their results, "
+        "if any, are dropped as late)",
+    )
+    add("worker-index", type=int, help=argparse.SUPPRESS)
+    add(
+        "stats-interval",
+        type=int,
+        default=100,
+        help="Number of frames between logging the per-stage statistics (0 to disable)",
+    )
+    add(
+        "metrics-port",
+        type=int,
+        default=0,
+        help="Port on which the per-stage statistics are served on request (0 to disable); "
+        "pool workers use the following ports, in turn",
+    )
+    add(
+        "log-level",
+        default="info",
+        choices=LOG_LEVELS,
+        help="Level of the server log messages (per-frame messages are logged at the debug level)",
+    )
+    add(
+        "load-in-background",
+        action="store_true",
+        help="Connect immediately and load the model in the background: until the model is ready, "
+        "the status is 'warming', and the incoming frames are reported as dropped",
+    )
+    add(
+        "cache-dir",
+        help="Directory in which the model config, the class name embeddings (unless --embedding-cache-file "
+        "is given) and the compiled model (with --compile) are cached across runs, for faster restarts",
+    )
+    add(
+        "stand-in",
+        action="store_true",
+        help="Replace the model with a CPU stand-in, for benchmarking the serving code",
+    )
+    add(
+        "stand-in-cost",
+        type=float,
+        default=0,
+        help="Time (in milliseconds) taken by each forward pass of the stand-in model",
+    )
+    add(
+        "stand-in-frame-cost",
+        type=float,
+        default=50,
+        help="Additional time (in milliseconds) taken by the stand-in model for each image in a forward pass",
+    )
+    add(
+        "stand-in-reset-cost",
+        type=float,
+        default=0,
+        help="Time (in milliseconds) taken by the stand-in model to re-compute the encodings of a vocabulary",
+    )
+    add(
+        "stand-in-instances",
+        type=int,
+        default=5,
+        help="Number of instances predicted by the stand-in model in each image",
+    )
+
+
+def read_options(message, args):
+    """
+    Reads the per-request options, carried in an optional third message element, and fills in the
+    server defaults for the missing or invalid ones.
+
+    Args:
+        message (list): the message of a request: [image, classes] or [image, classes, options].
+        args (argparse.Namespace): the server arguments.
+
+    Returns:
+        options (dict): the options of the request.
+    """
+    options = {}
+    if len(message) > 2 and isinstance(message[2], dict):
+        for key, value in message[2].items():
+            # the keys which are not strings (e.g. integers) are kept as they are, and ignored as unknown options
+            if isinstance(key, bytes):
+                key = key.decode()
+            options[key] = value.decode() if isinstance(value, bytes) else value
+    if options.get('format') not in OUTPUT_FORMATS:
+        if 'format' in options:
+            log.warning(f'Unknown output format {options["format"]}, using {args.output_format}')
+        options['format'] = args.output_format
+    if 'scale' in options:
+        scale = options['scale']
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or not 0 < scale <= 1:
+            log.warning(f'Invalid input scale {scale}, using 1')
+            del options['scale']
+    threshold = options.get('threshold', args.score_threshold)
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or not 0 <= threshold <= 1:
+        log.warning(f'Invalid score threshold {threshold}, using {args.score_threshold}')
+        threshold = args.score_threshold
+    options['threshold'] = threshold
+    max_instances = options.get('maxInstances', args.max_instances)
+    if isinstance(max_instances, bool) or not isinstance(max_instances, int) or max_instances < 0:
+        log.warning(f'Invalid maximum number of instances {max_instances}, using {args.max_instances}')
+        max_instances = args.max_instances
+    options['maxInstances'] = max_instances
+    tolerance = options.get('tolerance', args.polygon_tolerance)
+    if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or tolerance < 0:
+        log.warning(f'Invalid polygon tolerance {tolerance}, using {args.polygon_tolerance}')
+        tolerance = args.polygon_tolerance
+    options['tolerance'] = tolerance
+    if options.get('outputs') not in OUTPUTS:
+        if 'outputs' in options:
+            log.warning(f'Unknown outputs {options["outputs"]}, using {args.outputs}')
+        options['outputs'] = args.outputs
+    return options
@@ -0,0 +1,212 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import numpy as np
+import torch
+
+# OpenCV is optional: it traces the exact contours of the masks for the polygon outputs, which
+# otherwise fall back to the outlines of the row spans of the masks
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Formats in which the predictions can be returned: nested lists (the default), or compact
+# binary encodings of the masks as bit-packed rows, COCO-style run-lengths, or raw bytes
+OUTPUT_FORMATS = ['lists', 'packbits', 'rle', 'raw']
+
+# Outputs which can be returned for each instance: its mask (along with its box), only its box,
+# or the simplified polygons outlining its mask (along with its box)
+OUTPUTS = ['masks', 'boxes', 'polygons']
+
+
+def select_instances(scores, threshold=0, max_instances=0):
+    """
+    Selects the predicted instances which score above the threshold, and only the top-scoring
+    ones (in decreasing score order) when there are more than max_instances (if not 0).
+
+    Args:
+        scores (torch.Tensor): the scores of the instances, of shape (N,).
+        threshold (float): the minimum score of the selected instances.
+        max_instances (int): the maximum number of selected instances (0 for no limit).
+
+    Returns:
+        indices (torch.Tensor): the indices of the selected instances.
+    """
+    indices = torch.nonzero(scores > threshold).squeeze(1)
+    if 0 < max_instances < len(indices):
+        indices = indices[scores[indices].topk(max_instances).indices]
+    return indices
+
+
+def get_results(predictions, format, outputs='masks', tolerance=1.0):
+    """
+    Assembles the results from the predictions of an image in the requested format, emitting all the
+    instances in one pass (the masks are only cropped and encoded when they are in the predictions,
+    or converted to polygons when those are requested instead).
+
+    Args:
+        predictions (dict): the predictions, as returned by ModelAdapter.postprocess.
+        format (str): one of OUTPUT_FORMATS.
+        outputs (str): one of OUTPUTS.
+        tolerance (float): the maximum distance (in pixels) between the simplified polygons and the
+            outlines of the masks, with the polygon outputs.
+
+    Returns:
+        results (dict): the results, as serialized in the messages.
+    """
+    results = {}
+    pred_boxes = predictions["pred_boxes"]
+    pred_scores = predictions["scores"]
+    crops = None
+    polygons = None
+    if "pred_masks" in predictions:
+        if outputs == 'polygons':
+            polygons = get_polygons(predictions["pred_masks"], pred_boxes, tolerance)
+        else:
+            crops = get_crops(predictions["pred_masks"], pred_boxes)
+    results["pred_classes"] = predictions["pred_classes"].tolist()
+    if format == 'lists':
+        if crops is not None:
+            results["pred_masks"] = [crop.tolist() for crop in crops]
+        if polygons is not None:
+            results["pred_polygons"] = [[polygon.reshape(-1).tolist() for polygon in instance] for instance in polygons]
+        results["pred_boxes"] = pred_boxes.reshape(-1).tolist()
+        results["scores"] = pred_scores.tolist()
+    else:
+        if crops is not None:
+            results["pred_masks"] = [encode_mask(crop, format) for crop in crops]
+        if polygons is not None:
+            results["pred_polygons"] = [[encode_array(polygon.astype('<i4')) for polygon in instance] for instance in polygons]
+        results["format"] = format
+        results["pred_boxes"] = encode_array(pred_boxes.astype('<f4'))
+        results["scores"] = encode_array(pred_scores.astype('<f4'))
+    return results
+
+
+def get_crops(masks, boxes):
+    # the corners of all the boxes are truncated and clipped to the masks at once,
+    # and the crops are views of the masks rather than copies
+    height, width = masks.shape[1:]
+    corners = np.clip(boxes.astype(np.int64), 0, [width, height, width, height])
+    return [mask[y0:y1, x0:x1] for mask, (x0, y0, x1, y1) in zip(masks, corners.tolist())]
+
+
+def get_polygons(masks, boxes, tolerance=1.0):
+    """
+    Converts the masks of the instances to simplified polygons, in the coordinates of the masks.
+
+    With OpenCV, the polygons are the outer contours of the connected parts of each mask. Otherwise,
+    the row spans of all the masks are found at once, and each run of consecutive non-empty rows of a
+    mask is outlined by the left ends of its spans, downwards, then by their right ends, upwards (which
+    fills in the concavities along the rows). The polygons are then simplified with the Ramer-Douglas-
+    Peucker algorithm, to within the tolerance.
+
+    Args:
+        masks (np.ndarray): the masks of the instances, of shape (N, H, W).
+        boxes (np.ndarray): the boxes of the instances, of shape (N, 4), which bound their masks.
+        tolerance (float): the maximum distance (in pixels) between the simplified polygons and the outlines.
+
+    Returns:
+        polygons (list[list[np.ndarray]]): the polygons of each instance, as arrays of shape (K, 2)
+            of the X and Y coordinates of the pixels at their vertices.
+    """
+    if cv2 is not None:
+        polygons = []
+        for crop, (x0, y0) in zip(get_crops(masks, boxes), np.clip(boxes[:, :2].astype(np.int64), 0, None).tolist()):
+            contours, _ = cv2.findContours(np.ascontiguousarray(crop, dtype=np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+            if tolerance > 0:
+                contours = [cv2.approxPolyDP(contour, tolerance, True) for contour in contours]
+            polygons.append([contour.reshape(-1, 2) for contour in contours])
+        return polygons
+
+    width = masks.shape[2]
+    rows = masks.any(axis=2)
+    left = masks.argmax(axis=2)
+    right = width - 1 - masks[:, :, ::-1].argmax(axis=2)
+    polygons = []
+    for instance_rows, instance_left, instance_right in zip(rows, left, right):
+        y = np.flatnonzero(instance_rows)
+        instance_polygons = []
+        for run in np.split(y, np.flatnonzero(np.diff(y) > 1) + 1) if len(y) > 0 else []:
+            outline = np.concatenate([np.stack([instance_left[run], run], axis=1),
+                                      np.stack([instance_right[run], run], axis=1)[::-1]])
+            instance_polygons.append(simplify_polygon(outline, tolerance))
+        polygons.append(instance_polygons)
+    return polygons
+
+
+def simplify_polygon(points, tolerance):
+    """
+    Simplifies a closed polygon with the Ramer-Douglas-Peucker algorithm, keeping the vertices
+    which lie further than the tolerance from the simplified outline.
+
+    Args:
+        points (np.ndarray): the vertices of the polygon, of shape (K, 2).
+        tolerance (float): the maximum distance (in pixels) between the simplified polygon and the vertices.
+
+    Returns:
+        points (np.ndarray): the vertices of the simplified polygon.
+    """
+    if tolerance <= 0 or len(points) < 4:
+        return points
+
+    # the polygon is split into two chains at its first vertex and the vertex furthest from it,
+    # and each chain is subdivided at its vertex furthest from its chord, until within the tolerance
+    ring = np.concatenate([points, points[:1]]).astype(np.float64)
+    keep = np.zeros(len(ring), dtype=bool)
+    far = int(np.argmax(((ring - ring[0]) ** 2).sum(axis=1)))
+    keep[[0, far]] = True
+    chains = [(0, far), (far, len(points))]
+    while chains:
+        start, end = chains.pop()
+        if end - start < 2:
+            continue
+        chord = ring[end] - ring[start]
+        offsets = ring[start + 1:end] - ring[start]
+        length = np.hypot(*chord)
+        if length > 0:
+            distances = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+        else:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            keep[start + 1 + i] = True
+            chains += [(start, start + 1 + i), (start + 1 + i, end)]
+    return points[keep[:len(points)]]
+
+
+def encode_array(array):
+    """
+    Encodes an array as a msgpack bin payload, along with its shape and (little-endian) dtype.
+    """
+    array = np.ascontiguousarray(array)
+    return {u"shape": list(array.shape), u"dtype": array.dtype.name, u"data": array.tobytes()}
+
+
+def encode_mask(mask, format):
+    """
+    Encodes a mask in one of the binary formats:
+    - packbits: each row packed into bytes, least significant bit first
+    - rle: COCO-style uncompressed run-lengths over the column-major pixels, starting with a run of zeros
+    - raw: one byte per pixel
+    """
+    mask = mask.astype(bool, copy=False)
+    if format == 'packbits':
+        return {u"shape": list(mask.shape), u"data": np.packbits(mask, axis=-1, bitorder='little').tobytes()}
+    elif format == 'rle':
+        return {u"size": list(mask.shape), u"counts": get_run_lengths(mask)}
+    else:
+        return encode_array(mask.view(np.uint8))
+
+
+def get_run_lengths(mask):
+    """
+    Computes the COCO-style run-lengths of a mask.
+    """
+    pixels = mask.ravel(order='F')
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [pixels.size]]))
+    if pixels.size > 0 and pixels[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.tolist()
@@ -0,0 +1,86 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import heapq
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class OutputSequencer(object):
+    """
+    Reorder buffer which releases the messages of the frames in non-decreasing originating time order.
+    Each frame is expected when it enters the pipeline, and completed when it leaves it (with its results,
+    or dropped), and the messages are held back until no earlier frame is still expected. A frame which
+    has been expected for longer than the hold window is skipped, i.e. no longer waited for, and the
+    messages of frames earlier than the last released one (such as the results of a skipped frame,
+    arriving after those of later frames) are discarded as late.
+
+    Args:
+        hold_window (float): the maximum time (in seconds) for which a frame is waited for (0 to never wait).
+    """
+    def __init__(self, hold_window):
+        self.hold_window = hold_window
+        self.lock = threading.Lock()
+        self.expected = {} # originating time -> time at which the frame entered the pipeline
+        self.held = [] # heap of (originating time, sequence number, message) of the held messages
+        self.sequence = 0
+        self.last_released = None
+        self.skipped = 0
+        self.late = 0
+
+    def expect(self, originatingTime):
+        with self.lock:
+            self.expected.setdefault(originatingTime, time.time())
+
+    def complete(self, originatingTimes):
+        with self.lock:
+            for originatingTime in originatingTimes:
+                self.expected.pop(originatingTime, None)
+
+    def hold(self, originatingTime, message):
+        with self.lock:
+            heapq.heappush(self.held, (originatingTime, self.sequence, message))
+            self.sequence += 1
+
+    def is_holding(self):
+        return len(self.held) > 0
+
+    def release(self):
+        """
+        Returns:
+            released (list[tuple]): the (originating time, message) of the messages which can be released,
+                in originating time order.
+            late (list[tuple]): the (originating time, message) of the late messages, which are discarded.
+        """
+        released = []
+        late = []
+        with self.lock:
+            # stop waiting for the frames which have been expected for too long
+            now = time.time()
+            for originatingTime, expected_time in list(self.expected.items()):
+                if now - expected_time >= self.hold_window and len(self.held) > 0 and originatingTime < self.held[0][0]:
+                    log.warning(f'Gave up waiting for the results of frame {originatingTime}')
+                    del self.expected[originatingTime]
+                    self.skipped += 1
+
+            # release the messages which are not preceded by any expected frame
+            oldest = min(self.expected) if len(self.expected) > 0 else None
+            while len(self.held) > 0 and (oldest is None or self.held[0][0] <= oldest):
+                originatingTime, _, message = heapq.heappop(self.held)
+                if self.last_released is not None and originatingTime < self.last_released:
+                    log.warning(f'Discarding late results of frame {originatingTime}')
+                    late.append((originatingTime, message))
+                    self.late += 1
+                    continue
+                released.append((originatingTime, message))
+                self.last_released = originatingTime
+        return released, late
+
+    def get_metrics(self):
+        return {u"held": len(self.held), u"expected": len(self.expected), u"skipped": self.skipped, u"late": self.late}
+
+    def __str__(self):
+        return f'{"sequencer":<12}{len(self.held)} held, {len(self.expected)} expected, {self.skipped} skipped, {self.late} late'
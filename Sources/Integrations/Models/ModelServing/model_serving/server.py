@@ -0,0 +1,780 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+import msgpack
+import numpy as np
+import torch
+import zmq
+
+from .broker import run_broker
+from .caches import ResultCache, VocabularyCache
+from .execution import load_compile_cache, save_compile_cache
+from .frames import FrameReader
+from .options import LOG_LEVELS, read_options
+from .results import get_results
+from .sequencer import OutputSequencer
+from .stats import StageStats
+from .tiling import get_input_memory, get_input_pixels, get_tiles, merge_tiles
+from .transport import DROP_REASONS, TICKS_PER_SECOND, UNIX_EPOCH_TICKS, get_reply_status, peek_originating_time, publish, reply_to_client, subscribe
+
+# Classes with which the model is warmed up, until the first frame requests its own
+PLACEHOLDER_CLASSES = ['object']
+
+# Stages of the pipeline which are timed (see StageStats), in pipeline order
+STAGES = ['recv', 'unpack', 'decode', 'preprocess', 'reset', 'infer', 'transfer', 'merge', 'assemble', 'pack', 'send', 'server', 'latency']
+
+# Interval (in seconds) at which the encode stage checks for held results to release, while it holds any
+SEQUENCER_POLL_INTERVAL = 0.01
+
+# Maximum delay (in seconds) with which dropped frames are reported, when no results are published
+DROPS_REPORT_INTERVAL = 0.1
+
+# Interval (in seconds) at which a pool worker checks for room in its decoded queue, to request more frames
+WORKER_POLL_INTERVAL = 0.01
+
+log = logging.getLogger(__name__)
+
+
+class ModelServer(object):
+    """
+    Serves a model behind a ModelAdapter, through a decode -> inference -> encode pipeline: the decode
+    thread receives the frames over zmq (published by psi, or sent as requests with the router
+    transport), decodes them and prepares the model inputs; the inference thread (the one calling run)
+    runs them through the model in batches; and the encode thread assembles and serializes the results,
+    and sends them. With --workers, the process instead acts as the front end of a pool of worker
+    processes (see run_broker).
+
+    Args:
+        adapter (ModelAdapter): the adapter of the model.
+        args (argparse.Namespace): the server arguments (see add_server_arguments).
+    """
+    def __init__(self, adapter, args):
+        self.adapter = adapter
+        self.args = args
+        self.is_worker = args.worker_index is not None
+        self.batch_size = max(1, args.batch_size)
+        self.batch_timeout = args.batch_timeout / 1000
+        self.model_ready = threading.Event()
+        self.classes = None
+        self.result_cache = None
+        if args.reuse_threshold > 0:
+            self.result_cache = ResultCache(args.reuse_threshold, args.reuse_max_age * TICKS_PER_SECOND / 1000)
+        self.vocabulary_cache = None
+        if args.vocabulary_cache_size > 0:
+            self.vocabulary_cache = VocabularyCache(args.vocabulary_cache_size, args.vocabulary_cache_memory * 2**20)
+        self.frame_reader = FrameReader()
+        self.clock_offset = time.time() - time.perf_counter() # for converting the stage times to psi times
+        self.memory_per_pixel = None # memory taken by a forward pass per input pixel, as measured after the warm-up
+        self.request_number = 0
+        self.requested_frames = 0 # frames requested from the front end and not received yet, in worker pool mode
+        self.last_processed = None
+
+        # The input socket is only used by the decode thread and the output socket only by the encode
+        # thread. With the router transport, the other threads send their replies through the replies socket.
+        self.context = zmq.Context.instance()
+        self.input = None
+        self.output = None
+        self.replies = None
+        self.input_poller = None
+        self.reply_sockets = threading.local()
+        self.client_requests = collections.Counter() # client identity -> number of requests in flight
+
+        # With the 'latest' and 'newest' input policies, the decoded queue only holds the frames that are kept
+        if args.input_policy == 'latest':
+            self.decoded_queue = queue.Queue(maxsize=1)
+        elif args.input_policy == 'newest':
+            self.decoded_queue = queue.Queue(maxsize=max(1, args.input_depth))
+        else:
+            self.decoded_queue = queue.Queue(maxsize=max(1, args.queue_size))
+        self.results_queue = queue.Queue(maxsize=max(1, args.queue_size))
+
+        # With the 'latest' and 'newest' policies, a server receiving published frames first receives all the frames
+        # waiting in its input socket, and only decodes those the decoded queue holds (see receive_latest)
+        self.receive_all = args.transport == 'pubsub' and not self.is_worker and args.input_policy != 'all'
+        self.received = collections.deque() # frames received and not decoded yet
+        self.stage_stats = {stage: StageStats(stage) for stage in STAGES}
+        self.stage_stats['infer'].queue = self.decoded_queue
+        self.stage_stats['assemble'].queue = self.results_queue
+        self.drops_lock = threading.Lock()
+        self.dropped_frames = []
+        self.drop_counts = {reason: 0 for reason in DROP_REASONS}
+        self.last_drops_time = 0 # originating time of the last drops report
+
+        # The results published on the output topic are sequenced in originating time order (in worker
+        # pool mode, by the front end, and with the router transport, each request is replied to instead)
+        self.sequencer = None
+        if args.transport == 'pubsub' and not self.is_worker:
+            self.sequencer = OutputSequencer(args.reorder_timeout / 1000)
+
+    def run(self):
+        """
+        Serves the model until the process is terminated.
+        """
+        args = self.args
+        logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=LOG_LEVELS[args.log_level])
+
+        # In worker pool mode, this process only acts as the front end for the worker processes
+        if args.workers > 0 and not self.is_worker:
+            run_broker(args)
+            return
+
+        if args.threads > 0:
+            torch.set_num_threads(args.threads)
+
+        # The cache directory also holds the compilation caches of torch (the path is resolved before
+        # loading the model, which may change the working directory)
+        if args.cache_dir is not None:
+            args.cache_dir = os.path.abspath(args.cache_dir)
+            os.makedirs(args.cache_dir, exist_ok=True)
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(args.cache_dir, 'inductor'))
+            os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+        # Load the model, either before connecting, or in the background once connected
+        if args.load_in_background:
+            threading.Thread(target=self.load_model_in_background, daemon=True).start()
+        else:
+            self.load_model()
+
+        if args.transport == 'router':
+            print(f'  Requests at:  tcp://127.0.0.1:{args.request_port} (up to {args.max_in_flight} in flight per client)')
+        else:
+            print(f'  Input at:     {args.input_connection}/{args.input_topic}')
+            print(f'  Output at:    {args.output_connection}/{args.output_topic}')
+            print(f'  Drops at:     {args.output_connection}/{args.drops_topic}')
+        print(f'  Batch size:   {self.batch_size} (timeout {args.batch_timeout} ms)')
+        print(f'  Input policy: {args.input_policy} (max staleness {args.max_staleness} ms)')
+        if self.result_cache is not None:
+            print(f'  Reuse:        within {args.reuse_threshold} gray levels, for up to {args.reuse_max_age} ms')
+
+        self.connect()
+        threading.Thread(target=self.receive_frames, daemon=True).start()
+        threading.Thread(target=self.send_results, daemon=True).start()
+        if args.metrics_port > 0:
+            metrics_port = args.metrics_port + (args.worker_index or 0)
+            print(f'  Metrics at:   tcp://127.0.0.1:{metrics_port}')
+            threading.Thread(target=self.serve_metrics, args=(metrics_port,), daemon=True).start()
+        self.model_ready.wait()
+
+        stats_count = 0
+        while True:
+            batch = self.get_batch()
+            self.process_batch(batch)
+
+            # log the per-stage statistics
+            stats_count += len(batch)
+            if args.stats_interval > 0 and stats_count >= args.stats_interval:
+                stats_count = 0
+                self.log_stats()
+
+    def load_model(self):
+        # loads the model (from the caches, with --cache-dir) and warms it up, before signalling that it is ready
+        args = self.args
+        start_time = time.perf_counter()
+        compile_cache = None
+        if args.cache_dir is not None and args.compile != 'off' and not args.stand_in:
+            compile_cache = os.path.join(args.cache_dir, 'compiled.bin')
+            load_compile_cache(compile_cache)
+
+        self.adapter.load()
+        if self.adapter.execution is not None:
+            print(f'  Execution:    {self.adapter.execution}{", compiled (" + args.compile + ")" if args.compile != "off" else ""}'
+                  f'{", channels-last" if args.channels_last else ""}, {torch.get_num_threads()} CPU threads')
+        print(f'  Input size:   {self.adapter.input_transform}')
+
+        # Warm up the model, for the first frames to be served at full speed (with placeholder
+        # classes, which the first frame replaces)
+        if args.warmup > 0:
+            print(f'Warming up with {args.warmup} batches of {args.warmup_size} images ...')
+            self.select_vocabulary(PLACEHOLDER_CLASSES)
+            self.warm_up(args.warmup, args.warmup_size)
+            if compile_cache is not None:
+                save_compile_cache(compile_cache)
+        if args.tile_memory > 0 and not args.stand_in:
+            self.select_vocabulary(PLACEHOLDER_CLASSES)
+            self.measure_memory(args.tile_size if args.tile_size > 0 else 1024)
+
+        print(f'Model ready in {time.perf_counter() - start_time:.1f} s.')
+        self.model_ready.set()
+
+    def load_model_in_background(self):
+        # the server exits if the model fails to load
+        try:
+            self.load_model()
+        except Exception:
+            log.exception('Failed to load the model')
+            os._exit(1)
+
+    def warm_up(self, passes, size):
+        # runs batches of random images through the model, both of the batch size and of a single image, so that
+        # the first frames do not pay for compiling the model, selecting its kernels or growing the allocator caches
+        width, height = map(int, size.split('x'))
+        pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        for count in sorted({1, self.batch_size}, reverse=True):
+            for _ in range(passes):
+                self.adapter.infer_batch([self.adapter.prepare(pixels, 'RGB') for _ in range(count)])
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def measure_memory(self, size):
+        # measures the peak memory taken by a forward pass on a single tile, per input pixel, for
+        # splitting the tiles into forward passes within the memory budget (only on CUDA devices)
+        if not torch.cuda.is_available():
+            return
+        inputs = self.adapter.prepare(np.zeros((size, size, 3), dtype=np.uint8), 'RGB')
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+        self.adapter.infer_batch([inputs])
+        torch.cuda.synchronize()
+        self.memory_per_pixel = (torch.cuda.max_memory_allocated() - baseline) / get_input_pixels(inputs)
+        log.info(f'Measured {self.memory_per_pixel:.0f} bytes of memory per input pixel')
+
+    def connect(self):
+        # sets up the incoming and outgoing zmq connections
+        args = self.args
+        print('\nEstablishing Zmq connections ...')
+        if self.is_worker:
+            # as a pool worker, frames are requested from the front end and the results are pushed back to it
+            print(f'  Worker:       {args.worker_index} of the front end at port {args.broker_port}')
+            self.input = self.context.socket(zmq.DEALER)
+            self.input.connect(f'tcp://127.0.0.1:{args.broker_port}')
+            self.output = self.context.socket(zmq.PUSH)
+            self.output.connect(f'tcp://127.0.0.1:{args.broker_port + 1}')
+        elif args.transport == 'router':
+            self.input = self.context.socket(zmq.ROUTER)
+            self.input.bind(f'tcp://127.0.0.1:{args.request_port}')
+        else:
+            # with the 'latest' and 'newest' policies, few frames are queued by zmq, to bound the latency
+            hwm = self.decoded_queue.maxsize if self.receive_all else None
+            self.input = subscribe(self.context, args.input_connection, args.input_topic, hwm)
+            self.output = publish(self.context, args.output_connection)
+
+        # With the router transport, the replies are sent back over the input socket, by the decode stage
+        if args.transport == 'router':
+            self.replies = self.context.socket(zmq.PULL)
+            self.replies.bind('inproc://replies')
+            self.input_poller = zmq.Poller()
+            self.input_poller.register(self.input, zmq.POLLIN)
+            self.input_poller.register(self.replies, zmq.POLLIN)
+        print('Zmq connections established.')
+
+    def read_request(self):
+        """
+        Receives the next request, and reads its message.
+
+        Returns:
+            frame (tuple): the (image, classes, originatingTime, receive_time, options, route) of the request,
+                where image is as returned by FrameReader.open, and route is the (client identity, correlation ID)
+                of the request with the router transport (None otherwise), or None if it cannot be read (in
+                which case it is reported as failed, or replied to with an error).
+        """
+        args = self.args
+        route = None
+        originatingTime = None
+        try:
+            log.debug(f'Waiting for request {self.request_number} ...')
+            if self.receive_all:
+                frames = self.receive_latest()
+                receive_time = time.perf_counter()
+            else:
+                self.wait_for_request()
+                receive_time = time.perf_counter()
+                frames = self.input.recv_multipart(copy=False)
+            if self.is_worker:
+                self.requested_frames -= 1
+            self.stage_stats['recv'].record(receive_time)
+            self.request_number += 1
+            if args.transport == 'pubsub':
+                payload = frames[1]
+            elif not self.is_worker:
+                # [client identity, correlation ID, payload]
+                route = (frames[0].bytes, frames[1].bytes)
+                payload = frames[2]
+                self.client_requests[route[0]] += 1
+            else:
+                # [topic, payload, client identity, correlation ID], as dispatched by the front end
+                route = (frames[2].bytes, frames[3].bytes)
+                payload = frames[1]
+            start_time = time.perf_counter()
+            message = msgpack.unpackb(payload.buffer, raw=True, strict_map_key=False)
+            self.stage_stats['unpack'].record(start_time)
+            originatingTime = message[b"originatingTime"]
+            image = self.frame_reader.open(message[b"message"][0])
+            classes = [name.decode().lower().strip() for name in message[b"message"][1]]
+            options = read_options(message[b"message"], args)
+            log.debug(f'Received request {self.request_number - 1} at {originatingTime}')
+            return (image, classes, originatingTime, receive_time, options, route)
+        except Exception as e:
+            log.warning(f'Failed to read request {self.request_number - 1}: {e}')
+            if route is not None:
+                self.send_reply(route, 'error', reason=str(e))
+            elif isinstance(originatingTime, int):
+                # reported as failed, which also tells the front end of a pool not to wait for its results
+                self.drop_frame(originatingTime, 'failed')
+            return None
+
+    def wait_for_request(self):
+        # with the router transport, the replies of the pipeline stages are forwarded to the clients meanwhile,
+        # and pool workers request more frames from the front end as room is made in their decoded queue
+        timeout = WORKER_POLL_INTERVAL * 1000 if self.is_worker else None
+        while True:
+            if self.is_worker:
+                self.request_frames()
+            if self.replies is None:
+                if self.input.poll(timeout):
+                    return
+                continue
+            events = dict(self.input_poller.poll(timeout))
+            if self.replies in events:
+                self.forward_replies()
+            if self.input in events:
+                return
+
+    def receive_latest(self):
+        # receives all the frames waiting in the input socket, and drops the oldest ones as superseded
+        # (before they are decoded), keeping as many as the decoded queue holds
+        if len(self.received) == 0:
+            self.wait_for_request()
+        while True:
+            try:
+                self.received.append(self.input.recv_multipart(zmq.NOBLOCK, copy=False))
+            except zmq.Again:
+                break
+        while len(self.received) > self.decoded_queue.maxsize:
+            frames = self.received.popleft()
+            try:
+                originatingTime = peek_originating_time(frames[1].buffer)
+            except Exception as e:
+                log.warning(f'Failed to read a superseded frame: {e}')
+                continue
+            if isinstance(originatingTime, int):
+                self.drop_frame(originatingTime, 'superseded')
+        return self.received.popleft()
+
+    def request_frames(self):
+        # requests a frame from the front end for each free place in the decoded queue (which only the
+        # decode stage fills), less the frames already requested, so that the frames it sends are never
+        # rejected, and the front end knows the free capacity of the whole pool from the requests
+        while self.requested_frames + self.decoded_queue.qsize() < self.decoded_queue.maxsize:
+            self.input.send(b'ready')
+            self.requested_frames += 1
+
+    def send_reply(self, route, status, payload=b'', reason=''):
+        """
+        Sends a reply to a request received with the router transport. The replies of all the stages are
+        sent through an inproc socket of their own thread, to the decode stage, which is the only user of
+        the input socket, and which forwards them to the clients (see forward_replies).
+
+        Args:
+            route (tuple): the (client identity, correlation ID) of the request.
+            status (str): the status of the request ('ok', 'dropped', 'busy' or 'error').
+            payload (bytes): the serialized results, for the 'ok' status.
+            reason (str): the reason for the status, for the other statuses.
+        """
+        socket = getattr(self.reply_sockets, 'socket', None)
+        if socket is None:
+            socket = self.reply_sockets.socket = self.context.socket(zmq.PUSH)
+            socket.connect('inproc://replies')
+        socket.send_multipart([route[0], route[1], status.encode(), reason.encode(), payload])
+
+    def forward_replies(self):
+        # forwards the replies of the pipeline stages: to the clients, or to the front end in
+        # worker pool mode, which then forwards them to the clients
+        while self.replies.poll(0):
+            identity, correlation_id, status, reason, payload = self.replies.recv_multipart()
+            if self.is_worker:
+                self.input.send_multipart([b'reply', identity, correlation_id, status, reason, payload])
+            else:
+                reply_to_client(self.input, self.client_requests, self.args.max_in_flight, identity, correlation_id, status, reason, payload)
+
+    def is_throttled(self, route):
+        # in worker pool mode, the front end keeps count of the requests of each client
+        return route is not None and not self.is_worker and self.client_requests[route[0]] > self.args.max_in_flight
+
+    def receive_frames(self):
+        # Decode stage: receives and decodes images over zmq, and queues them for inference
+        if self.is_worker:
+            self.model_ready.wait() # pool workers only ask for frames once they can process them
+        while True:
+            frame = self.read_request()
+            if frame is None:
+                continue
+            image, classes, originatingTime, receive_time, options, route = frame
+            if self.sequencer is not None:
+                self.sequencer.expect(originatingTime)
+            if not self.model_ready.is_set():
+                self.drop_frame(originatingTime, 'warming', route)
+                continue
+            if self.is_throttled(route):
+                self.drop_frame(originatingTime, 'throttled', route)
+                continue
+            try:
+                start_time = time.perf_counter()
+                pixels, order = self.frame_reader.decode(image)
+                self.stage_stats['decode'].record(start_time)
+                start_time = time.perf_counter()
+                results = None
+                if self.result_cache is not None:
+                    results = self.result_cache.lookup(self.result_cache.get_signature(pixels), classes, options, originatingTime)
+                if results is not None:
+                    # nearly identical to the last processed frame: its results go through the pipeline in place of the model inputs
+                    inputs = {"results": results}
+                elif 0 < self.args.tile_size < max(pixels.shape[:2]):
+                    inputs = self.prepare_tiles(pixels, order, options.get('scale', 1.0))
+                else:
+                    inputs = self.adapter.prepare(pixels, order, options.get('scale', 1.0))
+                self.stage_stats['preprocess'].record(start_time)
+            except Exception as e:
+                log.warning(f'Failed to decode frame {originatingTime}: {e}')
+                self.drop_frame(originatingTime, 'failed', route)
+                continue
+            self.queue_frame((inputs, classes, originatingTime, receive_time, options, route))
+
+    def prepare_tiles(self, pixels, order, scale=1.0):
+        # splits a large image into overlapping tiles, which are prepared as separate images (from views of the pixels)
+        height, width = pixels.shape[:2]
+        tiles = get_tiles(height, width, self.args.tile_size, self.args.tile_overlap)
+        return {"tiles": [self.adapter.prepare(pixels[y0:y1, x0:x1], order, scale) for x0, y0, x1, y1 in tiles],
+                "windows": tiles, "height": height, "width": width}
+
+    def queue_frame(self, frame):
+        # with the 'all' policy the decode stage blocks until there is room (or, with the router
+        # transport, rejects the frame as overloaded), otherwise the oldest frames are dropped
+        if self.args.input_policy == 'all':
+            if frame[5] is None:
+                self.decoded_queue.put(frame)
+                return
+            try:
+                self.decoded_queue.put_nowait(frame)
+            except queue.Full:
+                self.drop_frame(frame[2], 'overloaded', frame[5])
+            return
+        while True:
+            try:
+                self.decoded_queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    dropped = self.decoded_queue.get_nowait()
+                    self.drop_frame(dropped[2], 'superseded', dropped[5])
+                except queue.Empty:
+                    pass
+
+    def is_stale(self, frame):
+        # checks whether a frame lags behind the stream time extrapolated from
+        # the last processed frame by more than the staleness deadline
+        if self.args.max_staleness <= 0 or self.last_processed is None:
+            return False
+        last_originatingTime, last_time = self.last_processed
+        expected_originatingTime = last_originatingTime + (time.time() - last_time) * TICKS_PER_SECOND
+        if expected_originatingTime - frame[2] > self.args.max_staleness / 1000 * TICKS_PER_SECOND:
+            self.drop_frame(frame[2], 'stale', frame[5])
+            return True
+        return False
+
+    def drop_frame(self, originatingTime, reason, route=None):
+        """
+        Records a dropped frame, which is reported along with the next results (or within DROPS_REPORT_INTERVAL
+        seconds, if no results are published meanwhile), or with the router transport, replied to right away
+        (as busy, dropped or failed, depending on the reason).
+
+        Args:
+            originatingTime (int): the originating time of the frame.
+            reason (str): one of DROP_REASONS.
+            route (tuple): the route of the request, with the router transport.
+        """
+        with self.drops_lock:
+            if route is None:
+                self.dropped_frames.append(originatingTime)
+            self.drop_counts[reason] += 1
+        if self.sequencer is not None:
+            self.sequencer.complete([originatingTime])
+        if route is not None:
+            self.send_reply(route, get_reply_status(reason), reason=reason)
+
+    def get_batch(self):
+        # takes the frames already waiting in the decoded queue and waits up to batch_timeout seconds for more, up to batch_size
+        batch = []
+        while len(batch) == 0:
+            frame = self.decoded_queue.get()
+            if not self.is_stale(frame):
+                batch.append(frame)
+        deadline = time.time() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            try:
+                frame = self.decoded_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if not self.is_stale(frame):
+                batch.append(frame)
+        return batch
+
+    def process_batch(self, batch):
+        """
+        Runs a batch of decoded frames through the model, and queues their predictions for encoding.
+
+        Args:
+            batch (list[tuple]): the frames, as queued by the decode stage.
+        """
+        # group the images by their set of classes, so that each group runs in a single forward pass
+        # (frames re-using the results of a previous frame skip the model)
+        start_time = time.perf_counter()
+        groups = {}
+        batch_predictions = [None] * len(batch)
+        for index, (inputs, classes, originatingTime, receive_time, options, route) in enumerate(batch):
+            if "results" in inputs:
+                batch_predictions[index] = (None, inputs["results"], classes)
+            else:
+                groups.setdefault(tuple(classes), []).append(index)
+
+        # the group of the current vocabulary (if any) runs first, saving a change of vocabulary
+        for classes, indices in sorted(groups.items(), key=lambda group: list(group[0]) != self.classes):
+            try:
+                predictions = self.run_group(list(classes), [batch[i] for i in indices])
+            except Exception:
+                log.exception(f'Failed to run {len(indices)} frames through the model')
+                continue
+            for i, prediction in zip(indices, predictions):
+                batch_predictions[i] = (prediction, None, self.classes)
+
+        self.last_processed = (max(frame[2] for frame in batch), time.time())
+
+        # queue the predictions for encoding, in the order in which the images were received
+        for (inputs, classes, originatingTime, receive_time, options, route), prediction in zip(batch, batch_predictions):
+            if prediction is None:
+                self.drop_frame(originatingTime, 'failed', route)
+            else:
+                self.results_queue.put(prediction + (originatingTime, receive_time, start_time, options, route))
+
+    def run_group(self, classes, frames):
+        # runs frames requesting the same classes through the model, in a single forward pass
+
+        # if the new set of classes is different, then update
+        if self.classes != classes:
+            start_time = time.perf_counter()
+            self.select_vocabulary(classes)
+            self.stage_stats['reset'].record(start_time)
+
+        # get the predictions, for the tiles of the tiled frames along with the other frames
+        # (in several forward passes, if they do not fit in the memory budget)
+        batch_inputs = [inputs for frame in frames for inputs in frame[0].get("tiles", [frame[0]])]
+        predictions = []
+        for pass_inputs in self.get_passes(batch_inputs):
+            start_time = time.perf_counter()
+            predictions += self.adapter.infer_batch(pass_inputs)
+            self.stage_stats['infer'].record(start_time, len(pass_inputs))
+
+        # bring them back from the device, for the encode stage to only work on the CPU (and crop the
+        # predictions for letterboxed images to the original images), and merge those of the tiles
+        transferred = []
+        predictions = iter(predictions)
+        for frame in frames:
+            inputs, options = frame[0], frame[4]
+            start_time = time.perf_counter()
+            if "tiles" not in inputs:
+                transferred.append(self.adapter.postprocess(next(predictions), inputs, options))
+                self.stage_stats['transfer'].record(start_time)
+                continue
+            tile_predictions = [self.adapter.postprocess(next(predictions), tile_inputs, options) for tile_inputs in inputs["tiles"]]
+            self.stage_stats['transfer'].record(start_time)
+            start_time = time.perf_counter()
+            transferred.append(merge_tiles(tile_predictions, inputs["windows"], inputs["height"], inputs["width"],
+                                           self.args.tile_iou_threshold, options['maxInstances']))
+            self.stage_stats['merge'].record(start_time)
+        return transferred
+
+    def select_vocabulary(self, classes):
+        # swaps in the resident state of the vocabulary if it is in the vocabulary cache,
+        # otherwise re-computes it (and keeps it resident, if the model supports it)
+        self.classes = None # until the vocabulary is successfully selected
+        state = self.vocabulary_cache.get(classes) if self.vocabulary_cache is not None else None
+        if state is not None:
+            log.debug(f'Swapping in the resident encodings of {len(classes)} classes')
+            self.adapter.set_vocabulary(state)
+        else:
+            log.info(f'Re-computing encodings based on {len(classes)} classes ...')
+            self.adapter.reset_vocabulary(classes)
+            if self.vocabulary_cache is not None:
+                state = self.adapter.get_vocabulary()
+                if state is not None:
+                    self.vocabulary_cache.put(classes, state)
+        self.classes = classes
+
+    def get_passes(self, batch_inputs):
+        # splits the model inputs into forward passes which each fit in the memory budget (if any)
+        if self.args.tile_memory <= 0:
+            return [batch_inputs]
+        budget = self.args.tile_memory * 2**20
+        passes = [[]]
+        memory = 0
+        for inputs in batch_inputs:
+            input_memory = get_input_memory(inputs, self.memory_per_pixel)
+            if len(passes[-1]) > 0 and memory + input_memory > budget:
+                passes.append([])
+                memory = 0
+            passes[-1].append(inputs)
+            memory += input_memory
+        return passes
+
+    def send_results(self):
+        # Encode stage: assembles and serializes the results, and sends them over zmq (once sequenced)
+        while True:
+            try:
+                holding = self.sequencer is not None and self.sequencer.is_holding()
+                frame = self.results_queue.get(timeout=SEQUENCER_POLL_INTERVAL if holding else DROPS_REPORT_INTERVAL)
+            except queue.Empty:
+                # release the held results, and report the frames dropped meanwhile even if no results
+                # are published (e.g. while the model is warming, or when every frame is dropped)
+                if self.sequencer is not None:
+                    self.publish_sequenced()
+                self.write_drops()
+                continue
+            predictions, results, classes, originatingTime, receive_time, process_time, options, route = frame
+            start_time = time.perf_counter()
+            try:
+                if results is None:
+                    results = get_results(predictions, options['format'], options['outputs'], options['tolerance'])
+                    if self.result_cache is not None:
+                        self.result_cache.store(classes, options, results, originatingTime)
+            except Exception:
+                # the frame is reported as failed, and the encode stage goes on with the next frames
+                log.exception(f'Failed to assemble the results of frame {originatingTime}')
+                self.drop_frame(originatingTime, 'failed', route)
+                continue
+            self.stage_stats['assemble'].record(start_time)
+            if len(results["pred_classes"]) > 0 and log.isEnabledFor(logging.DEBUG):
+                log.debug(f'Detected {len(results["pred_classes"])} instances: {", ".join(classes[i] for i in results["pred_classes"])}')
+
+            # the times at which the frame was received, started being processed (after queueing) and finished
+            server_times = {}
+            server_times[u"received"] = self.get_ticks(receive_time)
+            server_times[u"started"] = self.get_ticks(process_time)
+            server_times[u"finished"] = self.get_ticks(time.perf_counter())
+            results = dict(results, serverTimes=server_times)
+
+            # send it, along with the frames dropped before it, once the results of the earlier frames are sent
+            if self.sequencer is None:
+                self.publish_results(results, originatingTime, receive_time, route)
+            else:
+                self.sequencer.complete([originatingTime])
+                self.sequencer.hold(originatingTime, (results, receive_time))
+                self.publish_sequenced()
+
+    def publish_sequenced(self):
+        # publishes the held results which are no longer preceded by the results of earlier frames
+        released, late = self.sequencer.release()
+        for originatingTime, _ in late:
+            self.drop_frame(originatingTime, 'late')
+        for originatingTime, (results, receive_time) in released:
+            self.publish_results(results, originatingTime, receive_time)
+
+    def publish_results(self, results, originatingTime, receive_time, route=None):
+        try:
+            self.write_results(results, originatingTime, route)
+        except Exception:
+            log.exception(f'Failed to send the results of frame {originatingTime}')
+            self.drop_frame(originatingTime, 'failed', route)
+            return
+        self.stage_stats['server'].record(receive_time)
+        self.stage_stats['latency'].add((time.time() * TICKS_PER_SECOND + UNIX_EPOCH_TICKS - originatingTime) / TICKS_PER_SECOND)
+        self.write_drops(originatingTime)
+        log.debug(f'Published the results of {originatingTime} after {(time.perf_counter() - receive_time) * 1000:.1f} ms')
+
+    def get_ticks(self, perf_time):
+        # converts a time.perf_counter time to psi ticks
+        return int((perf_time + self.clock_offset) * TICKS_PER_SECOND) + UNIX_EPOCH_TICKS
+
+    def write_results(self, results, originatingTime, route=None):
+        payload = {}
+        payload[u"originatingTime"] = originatingTime
+        payload[u"message"] = results
+        if route is None:
+            self.send_message(self.args.output_topic, payload, originatingTime, [originatingTime])
+            return
+        start_time = time.perf_counter()
+        payload = msgpack.dumps(payload)
+        self.stage_stats['pack'].record(start_time)
+        start_time = time.perf_counter()
+        self.send_reply(route, 'ok', payload)
+        self.stage_stats['send'].record(start_time)
+
+    def write_drops(self, originatingTime=None):
+        # reports the frames dropped since the last report, at the originating time of the results it goes
+        # along with (or else of the latest dropped frame), kept increasing along the drops topic
+        with self.drops_lock:
+            if len(self.dropped_frames) == 0:
+                return
+            drops = {}
+            drops[u"count"] = len(self.dropped_frames)
+            drops[u"originatingTimes"] = self.dropped_frames[:]
+            for reason in DROP_REASONS:
+                drops[reason] = self.drop_counts[reason]
+            self.dropped_frames.clear()
+        if originatingTime is None:
+            originatingTime = max(drops[u"originatingTimes"])
+        originatingTime = max(originatingTime, self.last_drops_time + 1)
+        self.last_drops_time = originatingTime
+        payload = {}
+        payload[u"originatingTime"] = originatingTime
+        payload[u"message"] = drops
+        self.send_message(self.args.drops_topic, payload, originatingTime, drops[u"originatingTimes"])
+
+    def send_message(self, topic, payload, originatingTime, completed):
+        # when running as a pool worker, the message also carries its originating time and those
+        # of the frames it completes, for the front end to publish the results in order, along with
+        # the index of the worker (for the front end to sum up the drop counts of the workers)
+        start_time = time.perf_counter()
+        frames = [topic.encode(), msgpack.dumps(payload)]
+        if self.is_worker:
+            frames.append(msgpack.dumps([originatingTime, completed, self.args.worker_index]))
+        self.stage_stats['pack'].record(start_time)
+        start_time = time.perf_counter()
+        self.output.send_multipart(frames)
+        self.stage_stats['send'].record(start_time)
+
+    def get_metrics(self):
+        """
+        Returns:
+            metrics (dict): the current statistics of all the stages, along with the status of the model,
+                the drop counts and the cache counters, as served on the metrics socket.
+        """
+        metrics = {}
+        metrics[u"stages"] = {name: stats.summary() for name, stats in self.stage_stats.items()}
+        with self.drops_lock:
+            metrics[u"drops"] = dict(self.drop_counts)
+        if self.adapter.embedding_cache is not None:
+            metrics[u"cache"] = self.adapter.embedding_cache.get_metrics()
+        if self.result_cache is not None:
+            metrics[u"reuse"] = self.result_cache.get_metrics()
+        if self.vocabulary_cache is not None:
+            metrics[u"vocabularies"] = self.vocabulary_cache.get_metrics()
+        if self.sequencer is not None:
+            metrics[u"sequencer"] = self.sequencer.get_metrics()
+        metrics[u"status"] = u"ready" if self.model_ready.is_set() else u"warming"
+        return metrics
+
+    def serve_metrics(self, port):
+        # Metrics stage: answers each request on the metrics socket with the current statistics
+        metrics = self.context.socket(zmq.REP)
+        metrics.bind(f'tcp://127.0.0.1:{port}')
+        while True:
+            metrics.recv()
+            metrics.send(msgpack.dumps(self.get_metrics()))
+
+    def log_stats(self):
+        for stats in self.stage_stats.values():
+            log.info(stats)
+        if self.adapter.embedding_cache is not None:
+            log.info(self.adapter.embedding_cache)
+        if self.result_cache is not None:
+            log.info(self.result_cache)
+        if self.vocabulary_cache is not None:
+            log.info(self.vocabulary_cache)
+        if self.sequencer is not None:
+            log.info(self.sequencer)
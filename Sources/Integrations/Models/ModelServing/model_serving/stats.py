@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import collections
+import time
+import numpy as np
+
+
+class StageStats(object):
+    """
+    Per-stage statistics: number of frames processed, average and maximum latency, percentiles
+    of the latency over a rolling window of recent samples, and current depth of the queue
+    feeding the stage. Latencies are measured with time.perf_counter(), and are per frame: the time
+    taken by a batch of frames is recorded as that many samples of its time per frame.
+    """
+    def __init__(self, name, queue=None, window=1000):
+        self.name = name
+        self.queue = queue
+        self.count = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.samples = collections.deque(maxlen=window)
+
+    def record(self, start_time, count=1):
+        self.add(time.perf_counter() - start_time, count)
+
+    def add(self, elapsed, count=1):
+        self.count += count
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed / count)
+        self.samples.extend([elapsed / count] * count)
+
+    def summary(self):
+        """
+        Returns:
+            summary (dict): the frame count, and the mean, maximum and p50/p95/p99 latencies in milliseconds.
+        """
+        samples = np.array(self.samples.copy())
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000 if len(samples) > 0 else (0, 0, 0)
+        summary = {
+            u"count": self.count,
+            u"mean": self.total_time / self.count * 1000 if self.count > 0 else 0,
+            u"max": self.max_time * 1000,
+            u"p50": float(p50),
+            u"p95": float(p95),
+            u"p99": float(p99),
+        }
+        if self.queue is not None:
+            summary[u"queue"] = self.queue.qsize()
+            summary[u"queueSize"] = self.queue.maxsize
+        return summary
+
+    def __str__(self):
+        s = self.summary()
+        depth = f', queue {s["queue"]}/{s["queueSize"]}' if self.queue is not None else ''
+        return f'{self.name:<12}{s["count"]} frames, avg {s["mean"]:.1f} ms, p50 {s["p50"]:.1f} ms, p95 {s["p95"]:.1f} ms, p99 {s["p99"]:.1f} ms, max {s["max"]:.1f} ms{depth}'
@@ -0,0 +1,147 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import numpy as np
+
+# Distance (in pixels) from an inner edge of its tile within which the box of an instance is
+# considered cut by the edge, i.e. the instance is likely to extend into the neighboring tile
+SEAM_MARGIN = 2
+
+
+def get_tiles(height, width, tile_size, overlap):
+    """
+    Splits an image into overlapping square tiles, evenly spaced along each axis, with the
+    last tiles aligned to the bottom and right of the image.
+
+    Args:
+        height, width (int): the size of the image.
+        tile_size (int): the size of the side of the tiles (the tiles are cut to smaller images).
+        overlap (int): the minimum overlap (in pixels) between neighboring tiles.
+
+    Returns:
+        tiles (list[tuple]): the tiles, as (x0, y0, x1, y1) windows of the image.
+    """
+    def get_starts(length):
+        if length <= tile_size:
+            return [0]
+        count = int(np.ceil((length - overlap) / max(1, tile_size - overlap)))
+        return np.linspace(0, length - tile_size, max(2, count)).round().astype(int).tolist()
+
+    return [(x0, y0, min(width, x0 + tile_size), min(height, y0 + tile_size))
+            for y0 in get_starts(height) for x0 in get_starts(width)]
+
+
+def get_input_pixels(inputs):
+    """
+    Returns the number of pixels of the model input of an image (or of the image, if its
+    model inputs do not hold an "image" tensor).
+    """
+    image = inputs.get("image")
+    if image is None:
+        return inputs["height"] * inputs["width"]
+    return image.shape[-2] * image.shape[-1]
+
+
+def get_input_memory(inputs, memory_per_pixel=None):
+    """
+    Estimates the memory (in bytes) taken by a forward pass on the model inputs of an image: from the
+    memory per input pixel measured during the warm-up, if any, otherwise from the size of its input tensor.
+    """
+    if memory_per_pixel is not None:
+        return get_input_pixels(inputs) * memory_per_pixel
+    image = inputs.get("image")
+    return image.numel() * image.element_size() if image is not None else 3 * get_input_pixels(inputs)
+
+
+def merge_tiles(tile_predictions, tiles, height, width, iou_threshold=0.5, max_instances=0):
+    """
+    Merges the predictions of the tiles of an image into the predictions of the image. The instances of
+    different tiles are merged, when of the same class, if they are duplicates (their boxes overlap by
+    more than the IoU threshold, or the box of an instance cut by an inner edge of its tile mostly lies
+    within the other box), or if they are the two parts of an instance cut by the seam between their tiles
+    (both boxes are cut by the seam, on either side of it, and overlap along it by more than the IoU
+    threshold). Merged instances get the union of their boxes and masks, and the highest of their scores.
+
+    Args:
+        tile_predictions (list[dict]): the predictions of each tile, as returned by ModelAdapter.postprocess.
+        tiles (list[tuple]): the (x0, y0, x1, y1) windows of the tiles in the image.
+        height, width (int): the size of the image.
+        iou_threshold (float): the minimum overlap of the instances to merge.
+        max_instances (int): the maximum number of (top-scoring) merged instances (0 for no limit).
+
+    Returns:
+        predictions (dict): the predictions of the image, as returned by ModelAdapter.postprocess.
+    """
+    counts = [len(predictions["scores"]) for predictions in tile_predictions]
+    windows = np.repeat(np.array(tiles, dtype=np.float32).reshape(-1, 4), counts, axis=0)
+    boxes = np.concatenate([predictions["pred_boxes"] for predictions in tile_predictions]).astype(np.float32).reshape(-1, 4)
+    boxes += np.tile(windows[:, :2], 2)
+    scores = np.concatenate([predictions["scores"] for predictions in tile_predictions])
+    classes = np.concatenate([predictions["pred_classes"] for predictions in tile_predictions])
+    tile_indices = np.repeat(np.arange(len(tiles)), counts)
+    masks = "pred_masks" in tile_predictions[0]
+
+    # the edges of the boxes which are cut by an inner edge of their tile (left, top, right, bottom)
+    inner = np.concatenate([windows[:, :2] > 0, windows[:, 2:] < [width, height]], axis=1)
+    cut = inner & (np.abs(boxes - windows) <= SEAM_MARGIN)
+
+    # pairwise overlaps of all the instances at once
+    x0 = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y0 = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    x1 = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    y1 = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    intersections = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    ious = intersections / np.maximum(areas[:, None] + areas[None, :] - intersections, 1e-6)
+    within = intersections / np.maximum(areas[:, None], 1e-6) # fraction of the box of each row within the box of each column
+    duplicates = (ious > iou_threshold) | (cut.any(axis=1)[:, None] & (within > iou_threshold))
+
+    def get_spans_iou(start, end):
+        overlaps = np.clip(np.minimum(end[:, None], end[None, :]) - np.maximum(start[:, None], start[None, :]), 0, None)
+        lengths = end - start
+        return overlaps / np.maximum(lengths[:, None] + lengths[None, :] - overlaps, 1e-6)
+
+    # parts of an instance on either side of a vertical seam (cut on the right and on the left, overlapping
+    # horizontally and along the seam), or of a horizontal seam (cut at the bottom and at the top)
+    seams = (cut[:, None, 2] & cut[None, :, 0] & (x1 > x0) & (get_spans_iou(boxes[:, 1], boxes[:, 3]) > iou_threshold)) | \
+            (cut[:, None, 3] & cut[None, :, 1] & (y1 > y0) & (get_spans_iou(boxes[:, 0], boxes[:, 2]) > iou_threshold))
+    matches = (duplicates | duplicates.T | seams | seams.T) & (classes[:, None] == classes[None, :]) & \
+              (tile_indices[:, None] != tile_indices[None, :])
+
+    # groups of matching instances, as the connected components of the matches
+    groups = np.arange(len(scores))
+    for i, j in zip(*np.nonzero(np.triu(matches))):
+        gi, gj = groups[i], groups[j]
+        if gi != gj:
+            groups[groups == gj] = gi
+    leaders, groups = np.unique(groups, return_inverse=True)
+
+    merged_boxes = np.zeros((len(leaders), 4), dtype=np.float32)
+    merged_boxes[:, :2] = np.inf
+    np.minimum.at(merged_boxes[:, :2], groups, boxes[:, :2])
+    np.maximum.at(merged_boxes[:, 2:], groups, boxes[:, 2:])
+    merged_scores = np.zeros(len(leaders), dtype=scores.dtype)
+    np.maximum.at(merged_scores, groups, scores)
+    order = np.argsort(-merged_scores, kind='stable')
+    if 0 < max_instances < len(order):
+        order = order[:max_instances]
+    predictions = dict(pred_boxes=merged_boxes[order], scores=merged_scores[order], pred_classes=classes[leaders[order]])
+
+    # stitch the masks of the merged instances, pasting the masks of their parts within their boxes
+    # (outside of which the masks are empty, and the results crop them anyway)
+    if masks:
+        rank = np.full(len(leaders), -1)
+        rank[order] = np.arange(len(order))
+        merged_masks = np.zeros((len(order), height, width), dtype=bool)
+        corners = np.concatenate([np.floor(boxes[:, :2]), np.ceil(boxes[:, 2:])], axis=1).astype(np.int64)
+        corners = np.clip(corners, np.tile(windows[:, :2], 2).astype(np.int64), np.tile(windows[:, 2:], 2).astype(np.int64))
+        instance = 0
+        for predictions_of_tile, (tx0, ty0, tx1, ty1) in zip(tile_predictions, tiles):
+            for mask in predictions_of_tile["pred_masks"]:
+                r = rank[groups[instance]]
+                if r >= 0:
+                    x0, y0, x1, y1 = corners[instance].tolist()
+                    merged_masks[r, y0:y1, x0:x1] |= mask[y0 - ty0:y1 - ty0, x0 - tx0:x1 - tx0]
+                instance += 1
+        predictions["pred_masks"] = merged_masks
+    return predictions
@@ -0,0 +1,87 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import numpy as np
+import PIL.Image
+import torch
+import torch.nn.functional as F
+
+# OpenCV is optional: it provides the fastest resizing, which otherwise falls back to torch
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Methods for resizing the images to the model input size: with PIL (as the model was trained),
+# or with OpenCV (or torch if OpenCV is not installed), which is faster on large images
+RESIZE_METHODS = ['pil', 'fast']
+
+
+class InputTransform(object):
+    """
+    Resizes images to the model input size: their short side is resized to min_size, without
+    their long side exceeding max_size (0 for no limit), both scaled down by the per-request
+    scale. With letterbox, images are instead resized to fit in a square of side max_size, and
+    padded to it at the bottom and right, so that all the images have the same shape.
+    """
+    def __init__(self, min_size, max_size, method='pil', letterbox=False, resample=PIL.Image.BILINEAR):
+        if letterbox and max_size <= 0:
+            raise ValueError('letterboxing requires a maximum size')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.method = method
+        self.letterbox = letterbox
+        self.resample = resample
+
+    def get_output_shape(self, height, width, scale=1.0):
+        if self.letterbox:
+            ratio = self.max_size * scale / max(height, width)
+        else:
+            ratio = self.min_size * scale / min(height, width)
+            if self.max_size > 0 and max(height, width) * ratio > self.max_size * scale:
+                ratio = self.max_size * scale / max(height, width)
+        return int(height * ratio + 0.5), int(width * ratio + 0.5)
+
+    def resize(self, image, height, width):
+        if image.shape[:2] == (height, width):
+            return image
+        image = np.ascontiguousarray(image)
+        if self.method == 'pil':
+            return np.asarray(PIL.Image.fromarray(image).resize((width, height), self.resample))
+        if cv2 is not None:
+            return cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+        pixels = torch.from_numpy(image).permute(2, 0, 1).unsqueeze(0)
+        return F.interpolate(pixels, size=(height, width), mode='bilinear', align_corners=False)[0].permute(1, 2, 0).numpy()
+
+    def __call__(self, image, scale=1.0):
+        """
+        Args:
+            image (np.ndarray): an image of shape (H, W, C).
+            scale (float): factor (in (0, 1]) by which to scale down the input size for this image.
+
+        Returns:
+            image (np.ndarray): the resized (and padded) image.
+            inputs (dict): the size of the original image, at which the model outputs the predictions.
+                For letterboxed images, the predictions are output at the size which maps the padded
+                image back to the original image coordinates, and have to be cropped to "crop".
+        """
+        height, width = image.shape[:2]
+        new_height, new_width = self.get_output_shape(height, width, scale)
+        image = self.resize(image, new_height, new_width)
+        if not self.letterbox:
+            return image, {"height": height, "width": width}
+        side = -(-int(self.max_size * scale + 0.5) // 32) * 32
+        padded = np.zeros((side, side) + image.shape[2:], dtype=image.dtype)
+        padded[:new_height, :new_width] = image
+        inputs = {"height": round(side * height / new_height), "width": round(side * width / new_width), "crop": (height, width)}
+        return padded, inputs
+
+    def __str__(self):
+        return f'{self.min_size} to {self.max_size or "any"} ({self.method} resize{", letterboxed" if self.letterbox else ""})'
+
+
+def pin(tensor):
+    """
+    Pins a tensor in page-locked memory (when CUDA is available), for it to be copied to the GPU asynchronously.
+    """
+    return tensor.pin_memory() if torch.cuda.is_available() else tensor
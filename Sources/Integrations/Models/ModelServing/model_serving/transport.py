@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import msgpack
+import zmq
+
+# psi originating times are expressed in 100ns ticks since 0001-01-01 (UTC)
+TICKS_PER_SECOND = 10000000
+UNIX_EPOCH_TICKS = 621355968000000000
+
+# Transports over which frames are received and results returned: published frames and results
+# (pubsub), or requests from clients which each get a reply (router)
+TRANSPORTS = ['pubsub', 'router']
+
+# Reasons for which frames are dropped: superseded by newer frames (with the 'latest' and 'newest'
+# input policies), stale, received while the model is loading, rejected with the router transport
+# (see BUSY_REASONS), failed to be decoded or run through the model, or completed too late to be
+# published in originating time order (see OutputSequencer)
+DROP_REASONS = ['superseded', 'stale', 'warming', 'overloaded', 'throttled', 'failed', 'late']
+
+# Reasons for which requests are rejected with a busy reply (rather than dropped), with the router
+# transport: the model is not loaded yet, the server is overloaded, or the client has too many requests in flight
+BUSY_REASONS = ['warming', 'overloaded', 'throttled']
+
+# Reasons for which requests get an error reply, with the router transport: their frame could not be
+# decoded or run through the model
+ERROR_REASONS = ['failed']
+
+
+def get_reply_status(reason):
+    """
+    Returns the status of the reply to a request which is not processed for the given reason.
+    """
+    if reason in BUSY_REASONS:
+        return 'busy'
+    return 'error' if reason in ERROR_REASONS else 'dropped'
+
+
+def subscribe(context, connection, topic, hwm=None):
+    """
+    Returns a socket connected to a psi publisher, and subscribed to one of its topics. With hwm, the
+    socket queues up to hwm received messages (beyond which zmq drops the further messages), rather than
+    zmq's default of 1000.
+    """
+    socket = context.socket(zmq.SUB)
+    if hwm is not None:
+        socket.setsockopt(zmq.RCVHWM, hwm)
+    socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+    socket.setsockopt(zmq.HEARTBEAT_IVL, 0)
+    socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 0)
+    socket.connect(connection)
+    return socket
+
+
+def publish(context, connection):
+    """
+    Returns a socket bound to the connection on which messages are published to psi.
+    """
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.HEARTBEAT_IVL, 0)
+    socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 0)
+    socket.bind(connection)
+    return socket
+
+
+def reply_to_client(socket, client_requests, max_in_flight, identity, correlation_id, status, reason, payload):
+    """
+    Sends a reply to a client of the router transport: [correlation ID, header, payload], where the
+    header holds the status of the request and the number of further requests the client may send
+    (its credits), now that the request being replied to is no longer in flight.
+
+    Args:
+        socket (zmq.Socket): the ROUTER socket on which the request was received.
+        client_requests (collections.Counter): the number of requests in flight of each client.
+        max_in_flight (int): the maximum number of requests of each client in flight.
+        identity, correlation_id, status, reason, payload (bytes): the parts of the reply.
+    """
+    client_requests[identity] -= 1
+    credits = max(0, max_in_flight - client_requests[identity])
+    if client_requests[identity] <= 0:
+        del client_requests[identity]
+    header = {u"status": status.decode(), u"credits": credits}
+    if len(reason) > 0:
+        header[u"reason"] = reason.decode()
+    socket.send_multipart([identity, correlation_id, msgpack.dumps(header), payload])
+
+
+def peek_originating_time(payload):
+    """
+    Reads the originating time of a psi message without unpacking the rest of it.
+    """
+    unpacker = msgpack.Unpacker(raw=True, strict_map_key=False)
+    unpacker.feed(payload)
+    for _ in range(unpacker.read_map_header()):
+        if unpacker.unpack() == b"originatingTime":
+            return unpacker.unpack()
+        unpacker.skip()
+    return None
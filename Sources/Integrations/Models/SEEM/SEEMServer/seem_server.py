@@ -11,28 +11,46 @@
 # --------------------------------------------------------
 
 import os
+import sys
 import torch
 import argparse
-import numpy as np
-import zmq, msgpack, time, io
+import time
 import importlib
+import numpy as np
 
 from PIL import Image
-from modeling.BaseModel import BaseModel
-from modeling import build_model
-from utils.arguments import load_opt_from_config_files
-from torchvision import transforms
-from detectron2.data import MetadataCatalog
-from detectron2.structures import BitMasks
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ModelServing'))
+from model_serving import ExecutionMode, ModelAdapter, ModelServer, add_server_arguments, get_config_files, load_cached, optimize_model, pin, select_instances
 
 def parse_option():
     parser = argparse.ArgumentParser('SEEM Demo', add_help=False)
     parser.add_argument('--conf_files', default="configs/seem/focall_unicl_lang_demo.yaml", metavar="FILE", help='path to config file', )
+    add_server_arguments(parser)
+    parser.set_defaults(score_threshold=0.8)
     cfg = parser.parse_args()
 
     return cfg
 
-def reset_classes(model, classes):
+# Imports the model code, which is only needed by the processes running the model (not by the
+# front end of a worker pool), and of which the stand-in model only needs detectron2 (see --stand_in)
+def import_model_code(stand_in):
+    global MetadataCatalog, Instances, BaseModel, build_model, load_opt_from_config_files
+    from detectron2.data import MetadataCatalog
+    from detectron2.structures import Instances
+    if stand_in:
+        return
+    from modeling.BaseModel import BaseModel
+    from modeling import build_model
+    from utils.arguments import load_opt_from_config_files
+
+# Gets the model options from the cache directory, where they are stored once loaded from the
+# config files, as long as the config files (including their base configs) and the device do not change
+def load_cached_opt(cache_dir, conf_files, device):
+    key = (get_config_files(conf_files), str(device))
+    return load_cached(cache_dir, 'opt', key, lambda: load_opt_from_config_files(conf_files))
+
+def reset_classes(model, classes, embedding_cache=None):
     metadata = MetadataCatalog.get(','.join(classes))
     metadata.thing_classes = classes
     metadata.thing_dataset_id_to_contiguous_id = {x:x for x in range(len(classes))}
@@ -40,15 +58,66 @@ def reset_classes(model, classes):
     # Update the model
     model.model.metadata = metadata
     model.model.sem_seg_head.num_classes = len(classes)
-    model.model.sem_seg_head.predictor.lang_encoder.get_text_embeddings(classes + ["background"], is_eval=True)
-
-@torch.no_grad()
-def run_instance_segmentation(model, image_ori, classes):
-    #image_ori = transform(image)
-    width = image_ori.size[0]
-    height = image_ori.size[1]
-    image_ori = np.asarray(image_ori)
-    images = torch.from_numpy(image_ori.copy()).permute(2,0,1).cuda()
+    lang_encoder = model.model.sem_seg_head.predictor.lang_encoder
+    if embedding_cache is None:
+        lang_encoder.get_text_embeddings(classes + ["background"], is_eval=True)
+    else:
+        # only encode the class names which are not in the cache (each class name is encoded
+        # independently of the others), then assemble the default text embeddings from the cache
+        def compute(names):
+            lang_encoder.get_text_embeddings(names, name='cache_miss', is_eval=True)
+            return lang_encoder.cache_miss_text_embeddings.cpu()
+        embeddings = embedding_cache.get(classes + ["background"], compute)
+        lang_encoder.default_text_embeddings = embeddings.to(model.model.device)
+
+# Gets the resident state of the current classes (their text embeddings on the device, along with their
+# metadata), for set_classes to swap them back in without re-computing them
+def get_classes(model):
+    return {"text_embeddings": model.model.sem_seg_head.predictor.lang_encoder.default_text_embeddings,
+            "num_classes": model.model.sem_seg_head.num_classes, "metadata": model.model.metadata}
+
+def set_classes(model, state):
+    model.model.metadata = state["metadata"]
+    model.model.sem_seg_head.num_classes = state["num_classes"]
+    model.model.sem_seg_head.predictor.lang_encoder.default_text_embeddings = state["text_embeddings"]
+
+# CPU stand-in for the model, for benchmarking the serving code without the model: takes a fixed
+# amount of time per forward pass and per image, and predicts randomly placed instances
+class StandInModel(object):
+    def __init__(self, cost, frame_cost, num_instances, reset_cost=0):
+        self.cost = cost
+        self.frame_cost = frame_cost
+        self.num_instances = num_instances
+        self.reset_cost = reset_cost
+        self.num_classes = 1
+        self.generator = torch.Generator().manual_seed(0)
+
+    def reset_classes(self, classes):
+        time.sleep(self.reset_cost)
+        self.num_classes = max(1, len(classes))
+
+    def run(self, batch_inputs):
+        start_time = time.perf_counter()
+        batch_results = [self.predict(data["height"], data["width"]) for data in batch_inputs]
+        remaining = self.cost + self.frame_cost * len(batch_inputs) - (time.perf_counter() - start_time)
+        if remaining > 0:
+            time.sleep(remaining)
+        return batch_results
+
+    def predict(self, height, width):
+        n = self.num_instances
+        corners = (torch.rand(n, 2, 2, generator=self.generator) * torch.tensor([width, height])).int()
+        masks = torch.zeros(n, height, width)
+        for mask, ((x0, y0), (x1, y1)) in zip(masks, corners.sort(dim=1).values.tolist()):
+            mask[y0:y1, x0:x1] = 1
+        instances = Instances((height, width))
+        instances.pred_masks = masks
+        instances.scores = torch.rand(n, generator=self.generator) * 0.5 + 0.5
+        instances.pred_classes = torch.randint(self.num_classes, (n,), generator=self.generator)
+        return instances
+
+def run_instance_segmentation(model, batch_inputs, execution):
+    batch_inputs = [dict(data, image=data["image"].to(model.model.device, non_blocking=True)) for data in batch_inputs]
 
     # initialize model tasks
     model.model.task_switch['spatial'] = False
@@ -56,67 +125,129 @@ def run_instance_segmentation(model, image_ori, classes):
     model.model.task_switch['grounding'] = False
     model.model.task_switch['audio'] = False
 
-    data = {"image": images, "height": height, "width": width}
-    batch_inputs = [data]
-
-    # run the inference
-    results = model.model.evaluate(batch_inputs)
-    instances = results[-1]["instances"]
-
-    # get the predictions (masks, boxes, scores and classes)
-    pred_masks = instances.pred_masks.cpu()
-    pred_boxes = BitMasks(pred_masks > 0).get_bounding_boxes()
-    pred_scores = instances.scores.detach().cpu()
-    pred_classes = instances.pred_classes.cpu().numpy()
-
-    # only keep predictions with a score greater than the threshold
-    keep = pred_scores > 0.8
-    pred_masks = pred_masks[keep]
-    pred_boxes = pred_boxes[keep]
-    pred_scores = pred_scores[keep]
-    pred_classes = pred_classes[keep]
-
-    # assemble the results
-    results = {}
-    pred_boxes = pred_boxes.tensor.cpu().numpy()
-    results["pred_boxes"] = pred_boxes.reshape(-1).tolist()
-    results["pred_classes"] = pred_classes.tolist()
-    results["scores"] = pred_scores.numpy().tolist()
-    results["pred_masks"] = [None] * len(pred_boxes)
-    for i in range(len(pred_boxes)):            
-        box = pred_boxes[i]
-        results["pred_masks"][i] = pred_masks[i][int(box[1]):int(box[3]), int(box[0]):int(box[2])].numpy().astype(bool).tolist()
-    if len(pred_boxes) > 0:
-        print(f'Detected {len(pred_boxes)} instances')
-        for i in results["pred_classes"]:
-            print(f'- {classes[i]}')
-
-    return results
-
-def readImage():
-    global request_number
-    try:
-        print(f'Waiting for request {request_number} ...', end='')
-        [topic, payload] = input.recv_multipart()
-        print('Received.')
-        request_number = request_number + 1
-        receive_time = time.time()
-        print('-> ', end='')
-        message = msgpack.unpackb(payload, raw=True, strict_map_key=False)
-        imageBytes = message[b"message"][0]
-        classes = message[b"message"][1]
-        image = Image.open(io.BytesIO(bytearray(imageBytes)))
-        originatingTime = message[b"originatingTime"]
-        return (image, classes, originatingTime, receive_time)
-    except:
-        print('Exception encountered')
-        return (0, 0, 0, 0)
-
-def writeResults(results, originatingTime):
-    payload = {}
-    payload[u"originatingTime"] = originatingTime
-    payload[u"message"] = results
-    output.send_multipart([output_topic.encode(), msgpack.dumps(payload)])
+    # run the inference on the whole batch
+    with execution():
+        batch_results = model.model.evaluate(batch_inputs)
+    return [r["instances"] for r in batch_results]
+
+# Brings the predictions of an image back from the device: the predictions scoring above the threshold
+# are selected (only the top-scoring ones, in decreasing score order, when there are more than
+# max_instances, if not 0), their masks are binarized (and cropped, for letterboxed images) and their
+# boxes are computed on the device, so that only the kept instances are copied, in a single copy per
+# field (and without their masks, when only their boxes are returned)
+@torch.no_grad()
+def transfer_instances(instances, crop=None, threshold=0.8, max_instances=0, masks=True):
+    keep = select_instances(instances.scores, threshold, max_instances)
+    pred_masks = instances.pred_masks[keep] > 0
+    if crop is not None:
+        pred_masks = pred_masks[:, :crop[0], :crop[1]]
+    boxes = get_bounding_boxes(pred_masks)
+    predictions = dict(pred_boxes=boxes.cpu().numpy(), scores=instances.scores[keep].cpu().numpy(), pred_classes=instances.pred_classes[keep].cpu().numpy())
+    if masks:
+        predictions["pred_masks"] = pred_masks.cpu().numpy()
+    return predictions
+
+# Computes the bounding boxes of boolean masks of shape (N, H, W), for all the masks at once: the
+# boxes span the first to the last rows and columns with any pixel set (empty masks get empty boxes)
+def get_bounding_boxes(masks):
+    height, width = masks.shape[1:]
+    if height == 0 or width == 0:
+        return torch.zeros(masks.shape[0], 4, device=masks.device)
+    rows = masks.any(dim=2).to(torch.uint8)
+    columns = masks.any(dim=1).to(torch.uint8)
+    boxes = torch.stack([columns.argmax(dim=1), rows.argmax(dim=1),
+                         width - columns.flip(1).argmax(dim=1), height - rows.flip(1).argmax(dim=1)], dim=1).float()
+    boxes[rows.amax(dim=1) == 0] = 0
+    return boxes
+
+# Adapter of the SEEM model (or of its stand-in, with --stand_in) for the serving core
+class SEEMAdapter(ModelAdapter):
+    name = 'SEEM'
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.model = None
+        self.stand_in = None
+
+    # imports the model code and builds the model (from the cached options and embeddings, with --cache_dir)
+    def load(self):
+        global seem_base_path
+        cfg = self.args
+        import_model_code(cfg.stand_in)
+        self.input_transform = self.get_input_transform(512, 0, Image.BICUBIC)
+        if cfg.stand_in:
+            print(f'Running SEEM server with a stand-in model')
+            self.stand_in = StandInModel(cfg.stand_in_cost / 1000, cfg.stand_in_frame_cost / 1000, cfg.stand_in_instances, cfg.stand_in_reset_cost / 1000)
+            return
+
+        seem_base_path = getSEEMBasePath()
+        print(f'Running SEEM server from {seem_base_path}')
+        os.chdir(seem_base_path)
+
+        if cfg.device is not None:
+            device = torch.device(cfg.device)
+        else:
+            device = torch.device("cuda", 0) if torch.cuda.is_available() else torch.device("cpu")
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        opt = load_cached_opt(cfg.cache_dir, [cfg.conf_files], device)
+        opt['device'] = device
+
+        if 'focalt' in cfg.conf_files:
+            pretrained_pth = os.path.join("seem_focalt_v0.pt")
+            if not os.path.exists(pretrained_pth):
+                os.system("wget {}".format("https://huggingface.co/xdecoder/SEEM/resolve/main/seem_focalt_v0.pt"))
+        elif 'focal' in cfg.conf_files:
+            pretrained_pth = os.path.join("seem_focall_v0.pt")
+            if not os.path.exists(pretrained_pth):
+                os.system("wget {}".format("https://huggingface.co/xdecoder/SEEM/resolve/main/seem_focall_v0.pt"))
+
+        # Build the model
+        self.model = BaseModel(opt, build_model(opt)).from_pretrained(pretrained_pth).eval().to(device)
+        optimize_model(self.model.model, cfg.compile, cfg.channels_last, dynamic=not cfg.letterbox)
+        self.execution = ExecutionMode(device.type, cfg.inference_mode, cfg.precision)
+        # the class name embeddings depend on the whole model options (including its weights)
+        self.embedding_cache = self.get_embedding_cache((sorted((k, v) for k, v in opt.items() if k != 'device'), pretrained_pth))
+
+    # resizes the pixels of an image (or a raw frame, straight from its buffer), and converts them
+    # to a tensor in pinned memory, ready to be copied to the GPU. The tensor never shares the frame
+    # buffer, which may be reused once prepare returns: it is copied out of it (by flipping the channels,
+    # or explicitly) when the transform leaves the pixels as they are.
+    def prepare(self, pixels, order, scale=1.0):
+        image, data = self.input_transform(pixels, scale)
+        shared = np.may_share_memory(image, pixels)
+        image = torch.from_numpy(image).permute(2,0,1)
+        if order == 'BGR':
+            image = image.flip(0)
+        elif shared:
+            image = image.clone(memory_format=torch.contiguous_format)
+        data["image"] = pin(image.contiguous())
+        return data
+
+    def reset_vocabulary(self, classes):
+        if self.stand_in is not None:
+            self.stand_in.reset_classes(classes)
+        else:
+            reset_classes(self.model, classes, self.embedding_cache)
+
+    def get_vocabulary(self):
+        if self.stand_in is not None:
+            return {"num_classes": self.stand_in.num_classes}
+        return get_classes(self.model)
+
+    def set_vocabulary(self, state):
+        if self.stand_in is not None:
+            self.stand_in.num_classes = state["num_classes"]
+        else:
+            set_classes(self.model, state)
+
+    def infer_batch(self, batch_inputs):
+        if self.stand_in is not None:
+            return self.stand_in.run(batch_inputs)
+        return run_instance_segmentation(self.model, batch_inputs, self.execution)
+
+    def postprocess(self, prediction, inputs, options):
+        return transfer_instances(prediction, inputs.get("crop"), options['threshold'], options['maxInstances'], options['outputs'] != 'boxes')
 
 def getSEEMBasePath():
     modeling_module_spec = importlib.util.find_spec('modeling')
@@ -124,81 +255,5 @@ def getSEEMBasePath():
     return seem_base_path
 
 if __name__ == "__main__":
-    seem_base_path = getSEEMBasePath()
-    print(f'Running SEEM server from {seem_base_path}')
-    os.chdir(seem_base_path)
-    
     cfg = parse_option()
-    opt = load_opt_from_config_files([cfg.conf_files])
-
-    torch.cuda.set_device(0)
-    opt['device'] = torch.device("cuda", 0)
-
-    if 'focalt' in cfg.conf_files:
-        pretrained_pth = os.path.join("seem_focalt_v0.pt")
-        if not os.path.exists(pretrained_pth):
-            os.system("wget {}".format("https://huggingface.co/xdecoder/SEEM/resolve/main/seem_focalt_v0.pt"))
-    elif 'focal' in cfg.conf_files:
-        pretrained_pth = os.path.join("seem_focall_v0.pt")
-        if not os.path.exists(pretrained_pth):
-            os.system("wget {}".format("https://huggingface.co/xdecoder/SEEM/resolve/main/seem_focall_v0.pt"))
-
-    # Build the model
-    model = BaseModel(opt, build_model(opt)).from_pretrained(pretrained_pth).eval().cuda()
-    classes = None
-
-    # Image transforms required by the model
-    t = []
-    t.append(transforms.Resize(512, interpolation=Image.BICUBIC))
-    transform = transforms.Compose(t)
-
-    # Setting up the zmq connection
-    input_connection = "tcp://127.0.0.1:36000"
-    input_topic = u"images"
-    output_connection = "tcp://127.0.0.1:36001"
-    output_topic = u"predictions"
-    request_number = 0
-
-    print(f'  Input at:     {input_connection}/{input_topic}')
-    print(f'  Output at:    {output_connection}/{output_topic}')
-
-    # Setup the incoming and outgoing ZMQ connection
-    print('\nEstablishing Zmq connections ...')
-    input = zmq.Context().socket(zmq.SUB)
-    input.setsockopt_string(zmq.SUBSCRIBE, input_topic)
-    input.setsockopt(zmq.HEARTBEAT_IVL, 0)
-    input.setsockopt(zmq.HEARTBEAT_TIMEOUT, 0)
-    input.connect(input_connection)
-    output = zmq.Context().socket(zmq.PUB)
-    output.setsockopt(zmq.HEARTBEAT_IVL, 0)
-    output.setsockopt(zmq.HEARTBEAT_TIMEOUT, 0)
-    output.bind(output_connection)
-
-    print('Zmq connections established.')
-
-    while True:
-
-        # read the image
-        image, new_classes, originatingTime, receive_time = readImage()
-
-        if image==0:
-            print('Continuing')
-            continue
-        
-        # if the new set of classes is different, then update
-        new_classes = list(map(str.strip, map(str.lower, map(bytes.decode, new_classes))))        
-        if classes != new_classes:
-            print(f'Re-computing encodings based on {len(new_classes)} classes ...')
-            classes = new_classes
-            reset_classes(model, new_classes)
-        
-        image = transform(image)
-        results = run_instance_segmentation(model, image, classes)
-
-        # print it
-        print(time.time() - receive_time, end='')
-
-        # send it
-        writeResults(results, originatingTime)
-
-        print('.')
+    ModelServer(SEEMAdapter(cfg), cfg).run()
@@ -0,0 +1,235 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import asyncio, inspect, logging
+from enum import IntEnum
+from RendezvousClient import RendezvousClient, RendezvousReader, RendezvousRegistry, RendezvousWriter
+
+log = logging.getLogger(__name__)
+
+# Async iterator over the (event, process) updates of an AsyncRendezvousClient, which subscribes to the
+# updates as soon as it is created (rather than on the first iteration), so that no update is missed.
+class RendezvousEvents:
+    def __init__(self, subscribers, end = False, error = None):
+        self.queue = asyncio.Queue()
+        self.subscribers = subscribers
+        self.subscribers.add(self.queue)
+        if end: # the client has already stopped
+            self.queue.put_nowait(error)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.queue not in self.subscribers and self.queue.empty():
+            raise StopAsyncIteration
+        event = await self.queue.get()
+        if event is None:
+            self.subscribers.discard(self.queue)
+            raise StopAsyncIteration
+        if isinstance(event, Exception):
+            self.subscribers.discard(self.queue)
+            raise event
+        return event
+
+    # Unsubscribes from the updates.
+    async def aclose(self):
+        self.subscribers.discard(self.queue)
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+# Asyncio client which connects to a RendezvousServer and relays rendezvous information.
+# Speaks the same protocol as RendezvousClient, and represents processes, endpoints and
+# streams in the same way, but never blocks the event loop: processes can be awaited as
+# they appear, and process updates can be consumed as an async stream of events.
+class AsyncRendezvousClient:
+    PROTOCOL_VERSION = RendezvousClient.PROTOCOL_VERSION
+
+    class Event(IntEnum):
+        ProcessAdded = 1
+        ProcessRemoved = 2
+
+    def __init__(self, host, port = 13331):
+        self.serverAddress = (host, port)
+        self.streamReader = None
+        self.streamWriter = None
+        self.incoming = RendezvousReader()
+        self.readTask = None
+        self.clientAddress = None
+        self.error = None
+        self.connected = False
+        self.registry = RendezvousRegistry()
+        self.rendezvous = self.registry.processes
+        self.onProcessAdded = None
+        self.onProcessRemoved = None
+        self.subscribers = set()
+        self.waiters = []
+
+    async def __send(self, writer):
+        self.streamWriter.write(writer.getvalue())
+        await self.streamWriter.drain()
+
+    # Receives until a complete message can be read with the given read function.
+    async def __receive(self, read):
+        while True:
+            message, complete = self.incoming.tryRead(read)
+            if complete:
+                return message
+            data = await self.streamReader.read(65536)
+            if not data:
+                raise ConnectionError('RendezvousServer disconnected.')
+            self.incoming.feed(data)
+
+    async def start(self, processAddedCallback = None, processRemovedCallback = None, timeout = None):
+        self.onProcessAdded = processAddedCallback
+        self.onProcessRemoved = processRemovedCallback
+        self.streamReader, self.streamWriter = await asyncio.wait_for(asyncio.open_connection(*self.serverAddress), timeout)
+        try:
+            writer = RendezvousWriter()
+            writer.writeShort(self.PROTOCOL_VERSION) # protocol version
+            await self.__send(writer)
+            version = await self.__receive(self.incoming.readShort)
+            if version != self.PROTOCOL_VERSION:
+                raise Exception('RendezvousClient protocol mismatch %d' % version)
+            self.clientAddress = await self.__receive(self.incoming.readString)
+            numProcesses = await self.__receive(self.incoming.readInt)
+            for _ in range(numProcesses):
+                await self.__readProcessUpdate()
+        except BaseException: # including cancellation
+            self.streamWriter.close()
+            self.streamReader = None
+            self.streamWriter = None
+            raise
+        self.connected = True
+        self.readTask = asyncio.ensure_future(self.__readProcessUpdates())
+
+    async def stop(self):
+        if self.streamWriter is not None:
+            try:
+                writer = RendezvousWriter()
+                writer.writeByte(0) # disconnect
+                await self.__send(writer)
+            except ConnectionError:
+                pass
+            self.streamWriter.close()
+        if self.readTask is not None:
+            self.readTask.cancel()
+            try:
+                await self.readTask
+            except asyncio.CancelledError:
+                pass
+
+    async def addProcess(self, process):
+        writer = RendezvousWriter()
+        writer.writeAddProcess(process)
+        await self.__send(writer)
+
+    async def removeProcess(self, process):
+        writer = RendezvousWriter()
+        writer.writeRemoveProcess(process)
+        await self.__send(writer)
+
+    # Waits for a process with the given name, returning it as soon as it is known.
+    async def waitForProcess(self, name, timeout = None):
+        return await self.__waitFor(lambda: self.registry.process(name),
+                                    lambda process: process if process.name == name else None,
+                                    timeout)
+
+    # Waits for an endpoint of the given kind (optionally of the given process, and publishing
+    # a stream with the given name), returning the (process, endpoint) as soon as it is known.
+    async def waitForEndpoint(self, endpointKind, processName = None, streamName = None, timeout = None):
+        def accept(e):
+            return e.kind == endpointKind and (processName is None or e.process.name == processName)
+        def lookup():
+            if streamName is not None:
+                endpoints = (s.endpoint for s in self.registry.streams(name=streamName))
+            else:
+                endpoints = self.registry.endpoints(endpointKind)
+            return next(((e.process, e) for e in endpoints if accept(e)), None)
+        def match(process):
+            for e in process.endpoints:
+                if accept(e) and (streamName is None or any(s.name == streamName for s in e.streams)):
+                    return (process, e)
+            return None
+        return await self.__waitFor(lookup, match, timeout)
+
+    # Iterates over the (event, process) updates received from now on (i.e. from the call, not from the
+    # first iteration), until the client is stopped or the iterator is closed.
+    def events(self):
+        ended = self.readTask is not None and self.readTask.done()
+        return RendezvousEvents(self.subscribers, ended, self.error)
+
+    # Waits for the first result of lookup (over the known processes) or match (over processes added later).
+    async def __waitFor(self, lookup, match, timeout):
+        if self.error is not None:
+            raise self.error
+        if not self.connected:
+            raise ConnectionError('RendezvousClient is not connected.')
+        result = lookup()
+        if result is not None:
+            return result
+        future = asyncio.get_running_loop().create_future()
+        waiter = (match, future)
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters.remove(waiter)
+
+    async def __readProcessUpdate(self):
+        update, value = await self.__receive(self.incoming.readProcessUpdate)
+        if update == 0: # disconnect
+            return False
+        elif update == 1: # add process
+            process = self.registry.add(value)
+            for match, future in self.waiters:
+                result = match(process)
+                if result is not None and not future.done():
+                    future.set_result(result)
+            await self.__notify(self.onProcessAdded, AsyncRendezvousClient.Event.ProcessAdded, process)
+            return True
+        else: # remove process
+            removed = self.registry.remove(value)
+            if removed is not None:
+                await self.__notify(self.onProcessRemoved, AsyncRendezvousClient.Event.ProcessRemoved, removed)
+            return True
+
+    # Invokes a callback (awaiting it, if it is a coroutine), so that an error in the callback does not end the
+    # reading of the process updates.
+    async def __notify(self, callback, event, process):
+        for queue in self.subscribers:
+            queue.put_nowait((event, process))
+        if callback is not None:
+            try:
+                result = callback(process)
+                if inspect.isawaitable(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Rendezvous callback failed for %r', process)
+
+    async def __readProcessUpdates(self):
+        end = None
+        try:
+            while await self.__readProcessUpdate():
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e: # e.g. connection lost, or corrupt stream
+            self.error = e
+            end = e
+        finally:
+            self.connected = False
+            # wake up anything still waiting on this client
+            for _, future in self.waiters:
+                if not future.done():
+                    future.set_exception(self.error if self.error is not None else ConnectionError('RendezvousServer disconnected.'))
+            for queue in self.subscribers:
+                queue.put_nowait(end)
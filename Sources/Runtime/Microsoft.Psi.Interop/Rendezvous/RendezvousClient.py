@@ -1,48 +1,594 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT license.
 
-import socket, struct, threading
+import logging, random, socket, struct, threading
+from collections import deque
 from enum import IntEnum
 
-# Client which connects to a RendezvousServer and relays rendezvous information.
-class RendezvousClient:
-    PROTOCOL_VERSION = 2
+log = logging.getLogger(__name__)
 
-    def __init__(self, host, port = 13331):
-        self.serverAddress = (host, port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# Builds rendezvous protocol messages in memory, so that each can be sent with a single sendall().
+class RendezvousWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+    def writeByte(self, b):
+        self.buffer += struct.pack('b', b)
+
+    def writeShort(self, s):
+        self.buffer += struct.pack('<h', s)
+
+    def writeInt(self, i):
+        self.buffer += struct.pack('<i', i)
+
+    def writeString(self, s):
+        # length prefixed with a LEB128 (7-bit encoded) integer, as read by .NET's BinaryReader
+        e = s.encode()
+        length = len(e)
+        while True:
+            b = length & 0x7f
+            length >>= 7
+            if length == 0:
+                self.buffer.append(b)
+                break
+            self.buffer.append(b | 0x80)
+        self.buffer += e
+
+    def writeEndpoint(self, e):
+        self.writeByte(e['endpoint'])
+        if e['endpoint'] == RendezvousClient.Endpoint.TcpSource:
+            self.writeString(e['host'])
+            self.writeInt(e['port'])
+        elif e['endpoint'] == RendezvousClient.Endpoint.NetMQSource:
+            self.writeString(e['address'])
+        elif e['endpoint'] == RendezvousClient.Endpoint.RemoteExporter:
+            self.writeString(e['host'])
+            self.writeInt(e['port'])
+            self.writeInt(e['transport'])
+        elif e['endpoint'] == RendezvousClient.Endpoint.RemoteClockExporter:
+            self.writeString(e['host'])
+            self.writeInt(e['port'])
+        else:
+            raise Exception('Unknown type of Endpoint.')
+        self.writeInt(len(e['streams']))
+        for s in e['streams']:
+            self.writeString(s['name'])
+            self.writeString(s['type'])
+
+    def writeAddProcess(self, process):
+        self.writeByte(1) # add process
+        self.writeString(process['name'])
+        self.writeString(process['version'])
+        self.writeInt(len(process['endpoints']))
+        for e in process['endpoints']:
+            self.writeEndpoint(e)
+
+    def writeRemoveProcess(self, process):
+        self.writeByte(2) # remove process
+        self.writeString(process['name'])
+
+# Parses rendezvous protocol messages out of the bytes received so far. Reads are exact: a message
+# which has not been completely received is left in the buffer until more bytes are fed.
+class RendezvousReader:
+    class Incomplete(Exception):
+        pass
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
 
-    def __sendByte(self, b):
-        self.socket.send(struct.pack('b', b))
+    def feed(self, data):
+        self.buffer += data
 
-    def __readByte(self):
-        b, = struct.unpack('b', self.socket.recv(1))
+    # Reads one complete message with the given read function, returning (message, True),
+    # or (None, False) without consuming anything if more bytes are needed.
+    def tryRead(self, read):
+        start = self.position
+        try:
+            message = read()
+        except RendezvousReader.Incomplete:
+            self.position = start
+            return None, False
+        del self.buffer[:self.position]
+        self.position = 0
+        return message, True
+
+    def __take(self, n):
+        end = self.position + n
+        if end > len(self.buffer):
+            raise RendezvousReader.Incomplete()
+        data = self.buffer[self.position:end]
+        self.position = end
+        return data
+
+    def readByte(self):
+        b, = struct.unpack('b', self.__take(1))
         return b
 
-    def __sendInt(self, c):
-        self.socket.send(struct.pack('<i', c))
+    def readShort(self):
+        s, = struct.unpack('<h', self.__take(2))
+        return s
 
-    def __readInt(self):
-        i, = struct.unpack('<i', self.socket.recv(4))
+    def readInt(self):
+        i, = struct.unpack('<i', self.__take(4))
         return i
 
-    def __sendString(self, s):
-        e = s.encode()
-        self.socket.send(struct.pack('b%ds' % len(e), len(e), e)) # assumes len < 128 (LEB128 encoded)
-    
-    def __readString(self):
-        len = self.__readByte()
-        buf = self.socket.recv(len)
-        str, = struct.unpack('%ds' % len, buf)
-        return str
+    def readString(self):
+        # length prefixed with a LEB128 (7-bit encoded) integer, as written by .NET's BinaryWriter
+        length = 0
+        shift = 0
+        while True:
+            b = self.__take(1)[0]
+            length |= (b & 0x7f) << shift
+            shift += 7
+            if b & 0x80 == 0:
+                break
+        return self.__take(length).decode()
+
+    def readStreams(self):
+        streams = []
+        count = self.readInt()
+        for _ in range(count):
+            name = self.readString()
+            type = self.readString()
+            streams.append(RendezvousClient.createStream(name, type))
+        return streams
+
+    def readEndpoint(self):
+        endpoint = RendezvousClient.Endpoint(self.readByte())
+        if endpoint == RendezvousClient.Endpoint.TcpSource:
+            host = self.readString()
+            port = self.readInt()
+            streams = self.readStreams()
+            return RendezvousClient.createTcpEndpoint(host, port, streams)
+        elif endpoint == RendezvousClient.Endpoint.NetMQSource:
+            address = self.readString()
+            streams = self.readStreams()
+            return RendezvousClient.createNetMQEndpoint(address, streams)
+        elif endpoint == RendezvousClient.Endpoint.RemoteExporter:
+            host = self.readString()
+            port = self.readInt()
+            transport = RendezvousClient.TransportKind(self.readInt())
+            streams = self.readStreams()
+            return RendezvousClient.createRemoteExporterEndpoint(host, port, transport, streams)
+        elif endpoint == RendezvousClient.Endpoint.RemoteClockExporter:
+            host = self.readString()
+            port = self.readInt()
+            self.readInt() # stream count (zero)
+            return RendezvousClient.createRemoteClockExporterEndpoint(host, port)
+        else:
+            raise Exception("Unknown type of Endpoint.")
+
+    def readProcess(self):
+        name = self.readString()
+        version = self.readString()
+        numEndpoints = self.readInt()
+        endpoints = []
+        for _ in range(numEndpoints):
+            endpoints.append(self.readEndpoint())
+        return RendezvousClient.createProcess(name, endpoints, version)
+
+    # Reads a process update as (0, None) for disconnect, (1, process) for an added process,
+    # or (2, name) for a removed process.
+    def readProcessUpdate(self):
+        update = self.readByte()
+        if update == 0: # disconnect
+            return update, None
+        elif update == 1: # add process
+            return update, self.readProcess()
+        elif update == 2: # remove process
+            return update, self.readString()
+        else:
+            raise Exception("Unexpected rendezvous action.")
+
+# Attribute of a record, reading the item of the same key (None if the record has no such item).
+def recordItem(key):
+    return property(lambda self: self.get(key))
+
+# Record of a stream published by a rendezvous endpoint. Records are dictionaries with the same items as
+# those returned by RendezvousClient.createStream (and so may be read, compared or serialized as such), which
+# may also be read as attributes, along with references to the records they belong to. They are otherwise
+# compared by identity, as they are indexed by the registry.
+class Stream(dict):
+    __slots__ = ('endpoint',)
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+    name = recordItem('name')
+    type = recordItem('type')
+
+    def __init__(self, name, type, endpoint):
+        super().__init__(name = name, type = type)
+        self.endpoint = endpoint
+
+    def __repr__(self):
+        return 'Stream(%r, %r)' % (self.name, self.type)
+
+# Record of a rendezvous endpoint, along with the process advertising it (the dictionary items are those
+# returned by RendezvousClient.create*Endpoint for its kind).
+class Endpoint(dict):
+    __slots__ = ('process',)
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+    kind = recordItem('endpoint')
+    host = recordItem('host')
+    port = recordItem('port')
+    address = recordItem('address')
+    transport = recordItem('transport')
+    streams = recordItem('streams')
+
+    def __init__(self, kind, process, host = None, port = None, address = None, transport = None):
+        super().__init__(endpoint = kind)
+        if kind == RendezvousClient.Endpoint.NetMQSource:
+            self['address'] = address
+        else:
+            self['host'] = host
+            self['port'] = port
+        if kind == RendezvousClient.Endpoint.RemoteExporter:
+            self['transport'] = transport
+        self['streams'] = []
+        self.process = process
+
+    def __repr__(self):
+        location = self.address if self.kind == RendezvousClient.Endpoint.NetMQSource else '%s:%s' % (self.host, self.port)
+        return 'Endpoint(%s, %s, %d streams)' % (self.kind.name, location, len(self.streams))
+
+# Record of a rendezvous process and its endpoints (the dictionary items are those returned by
+# RendezvousClient.createProcess).
+class Process(dict):
+    __slots__ = ()
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+    name = recordItem('name')
+    endpoints = recordItem('endpoints')
+    version = recordItem('version')
+
+    def __init__(self, name, version):
+        super().__init__(name = name, endpoints = [], version = version)
+
+    def __repr__(self):
+        return 'Process(%r, %r, %d endpoints)' % (self.name, self.version, len(self.endpoints))
+
+    @staticmethod
+    def fromDict(process):
+        p = Process(process['name'], process['version'])
+        for e in process['endpoints']:
+            endpoint = Endpoint(RendezvousClient.Endpoint(e['endpoint']), p, e.get('host'), e.get('port'), e.get('address'), e.get('transport'))
+            endpoint.streams.extend(Stream(s['name'], s['type'], endpoint) for s in e['streams'])
+            p.endpoints.append(endpoint)
+        return p
+
+# Point-in-time view of a RendezvousRegistry.
+class RendezvousSnapshot:
+    __slots__ = ('version', 'processes')
+
+    def __init__(self, version, processes):
+        self.version = version
+        self.processes = processes
+
+# Processes added (or replaced) and removed between a snapshot and a later version of a registry.
+class RendezvousDiff:
+    __slots__ = ('version', 'added', 'removed')
+
+    def __init__(self, version, added, removed):
+        self.version = version
+        self.added = added
+        self.removed = removed
+
+    def __bool__(self):
+        return len(self.added) > 0 or len(self.removed) > 0
+
+# Known rendezvous processes, indexed by stream name, stream type and endpoint kind so that streams
+# can be resolved without scanning every process. Each add or remove bumps the registry version,
+# and the names changed by recent versions are kept so that diffs cost only what changed.
+class RendezvousRegistry:
+    MAX_CHANGES = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.processes = {}
+        self.streamsByName = {}
+        self.streamsByType = {}
+        self.endpointsByKind = {}
+        self.changes = deque(maxlen=self.MAX_CHANGES) # (version, process name)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __contains__(self, name):
+        return name in self.processes
+
+    @staticmethod
+    def __index(index, key, record):
+        index.setdefault(key, {})[record] = None # dictionaries used as insertion ordered sets
+
+    @staticmethod
+    def __unindex(index, key, record):
+        records = index.get(key)
+        if records is not None:
+            records.pop(record, None)
+            if len(records) == 0:
+                del index[key]
+
+    def __removeLocked(self, name):
+        process = self.processes.pop(name, None)
+        if process is not None:
+            for e in process.endpoints:
+                self.__unindex(self.endpointsByKind, e.kind, e)
+                for s in e.streams:
+                    self.__unindex(self.streamsByName, s.name, s)
+                    self.__unindex(self.streamsByType, s.type, s)
+        return process
+
+    def __changed(self, name):
+        self.version += 1
+        self.changes.append((self.version, name))
+
+    # Adds (or replaces) a process, given as a record or as a dictionary from RendezvousClient.createProcess.
+    def add(self, process):
+        if not isinstance(process, Process):
+            process = Process.fromDict(process)
+        with self.lock:
+            self.__removeLocked(process.name)
+            self.processes[process.name] = process
+            for e in process.endpoints:
+                self.__index(self.endpointsByKind, e.kind, e)
+                for s in e.streams:
+                    self.__index(self.streamsByName, s.name, s)
+                    self.__index(self.streamsByType, s.type, s)
+            self.__changed(process.name)
+        return process
+
+    # Removes the named process, returning its record (or None if unknown).
+    def remove(self, name):
+        with self.lock:
+            process = self.__removeLocked(name)
+            if process is not None:
+                self.__changed(name)
+        return process
+
+    def clear(self):
+        with self.lock:
+            for name in list(self.processes):
+                self.__removeLocked(name)
+                self.__changed(name)
+
+    def process(self, name):
+        return self.processes.get(name)
+
+    # Streams with the given name and/or type, across all processes.
+    def streams(self, name = None, type = None):
+        with self.lock:
+            if name is not None:
+                streams = list(self.streamsByName.get(name, ()))
+                return streams if type is None else [s for s in streams if s.type == type]
+            if type is not None:
+                return list(self.streamsByType.get(type, ()))
+            return [s for streams in self.streamsByName.values() for s in streams]
+
+    # First stream with the given name (and, optionally, published by the given process), or None.
+    def stream(self, name, processName = None):
+        with self.lock:
+            for s in self.streamsByName.get(name, ()):
+                if processName is None or s.endpoint.process.name == processName:
+                    return s
+            return None
+
+    # Endpoints of the given kind, across all processes.
+    def endpoints(self, kind):
+        with self.lock:
+            return list(self.endpointsByKind.get(kind, ()))
+
+    def snapshot(self):
+        with self.lock:
+            return RendezvousSnapshot(self.version, dict(self.processes))
+
+    # Changes since the given snapshot (or since an empty registry, given None).
+    def diff(self, snapshot = None):
+        with self.lock:
+            before = snapshot.processes if snapshot is not None else {}
+            since = snapshot.version if snapshot is not None else 0
+            if len(self.changes) > 0 and self.changes[0][0] <= since + 1:
+                names = { name: None for version, name in self.changes if version > since }
+            elif since == self.version:
+                names = {}
+            else: # older than the retained changes, compare everything
+                names = dict.fromkeys(before)
+                names.update(dict.fromkeys(self.processes))
+            added = []
+            removed = []
+            for name in names:
+                old = before.get(name)
+                new = self.processes.get(name)
+                if new is not old:
+                    if old is not None:
+                        removed.append(old)
+                    if new is not None:
+                        added.append(new)
+            return RendezvousDiff(self.version, added, removed)
+
+# Client which connects to a RendezvousServer and relays rendezvous information.
+class RendezvousClient:
+    PROTOCOL_VERSION = 2
+
+    # Once started, the client reconnects whenever the connection is lost (unless reconnect is False), waiting
+    # from minBackoff up to maxBackoff seconds between attempts, and re-registers the processes it announced.
+    # TCP keepalives are sent after keepalive seconds of silence (0 to disable them), so that a dead server or
+    # link is detected within about twice as long. Connecting and the handshake time out after timeout seconds.
+    def __init__(self, host, port = 13331, reconnect = True, minBackoff = 0.5, maxBackoff = 30.0, keepalive = 10, timeout = 10.0):
+        self.serverAddress = (host, port)
+        self.socket = None
+        self.incoming = RendezvousReader()
+        self.registry = RendezvousRegistry()
+        self.rendezvous = self.registry.processes
+        self.reconnect = reconnect
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.clientAddress = None
+        self.onProcessAdded = None
+        self.onProcessRemoved = None
+        self.thread = None
+        self.lock = threading.Lock() # guards the socket when sending, and the announced processes
+        self.announced = {} # processes announced with addProcess, by name (re-registered upon reconnection)
+        self.withdrawn = set() # names of the announced processes removed while disconnected
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+
+    def __send(self, writer):
+        self.socket.sendall(writer.getvalue())
+
+    # Sends a message if connected (with the lock held), returning whether it was sent: otherwise, the
+    # message is left to the reconnection, which brings the server up to date with the announced processes.
+    def __trySend(self, writer):
+        if not self.connected.is_set():
+            if not self.reconnect:
+                raise ConnectionError('Not connected to RendezvousServer.')
+            return False
+        try:
+            self.__send(writer)
+            return True
+        except OSError:
+            if not self.reconnect:
+                raise
+            return False
+
+    # Receives until a complete message can be read with the given read function.
+    def __receive(self, read):
+        while True:
+            message, complete = self.incoming.tryRead(read)
+            if complete:
+                return message
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError('RendezvousServer disconnected.')
+            self.incoming.feed(data)
 
     def __sendProtocolVersion(self):
-        self.socket.send(struct.pack('<h', self.PROTOCOL_VERSION)) # protocol version
+        writer = RendezvousWriter()
+        writer.writeShort(self.PROTOCOL_VERSION) # protocol version
+        self.__send(writer)
 
     def __readProtocolVersion(self):
-        version, = struct.unpack('<h', self.socket.recv(2))
+        version = self.__receive(self.incoming.readShort)
         if version != self.PROTOCOL_VERSION:
-            raise Exception('RendezvousClient protocol mismatch %d' % self.PROTOCOL_VERSION);
+            raise Exception('RendezvousClient protocol mismatch %d' % version);
+
+    # Enables TCP keepalives on a socket: the rendezvous protocol has no heartbeat of its own, and the
+    # server only writes when processes change, so a dead server would otherwise go unnoticed.
+    def __enableKeepalive(self, s):
+        if not self.keepalive:
+            return
+        idle = max(1, int(self.keepalive))
+        interval = max(1, idle // 4)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'SIO_KEEPALIVE_VALS'): # Windows
+            s.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+            return
+        if hasattr(socket, 'TCP_KEEPIDLE'): # Linux
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, 'TCP_KEEPALIVE'): # macOS
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+        if hasattr(socket, 'TCP_USER_TIMEOUT'): # also give up on unacknowledged sends
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, 2 * idle * 1000)
+
+    # Connects to the server and goes through the handshake, returning the processes which the server
+    # knows of (as dictionaries, not yet applied to the registry).
+    def __connect(self):
+        self.socket = socket.create_connection(self.serverAddress, self.timeout)
+        try:
+            self.__enableKeepalive(self.socket)
+            self.incoming = RendezvousReader()
+            self.__sendProtocolVersion()
+            self.__readProtocolVersion()
+            self.clientAddress = self.__receive(self.incoming.readString)
+            numProcesses = self.__receive(self.incoming.readInt)
+            processes = []
+            for _ in range(numProcesses):
+                update, process = self.__receive(self.incoming.readProcessUpdate)
+                if update == 1: # add process
+                    processes.append(process)
+            self.socket.settimeout(None)
+            return processes
+        except:
+            self.socket.close()
+            raise
+
+    # Connects (or reconnects) to the server: the registry is brought in line with the processes known to
+    # the server (only notifying the processes which were actually added, changed or removed since the
+    # cached state), then the server is brought up to date with the processes announced by this client.
+    def __establish(self):
+        processes = self.__connect()
+        with self.lock:
+            announced = dict(self.announced)
+            withdrawn = set(self.withdrawn)
+        fresh = { p['name']: p for p in processes if p['name'] not in withdrawn }
+        for name in list(self.registry.snapshot().processes):
+            # the announced processes which the server lost (e.g. when restarted) are kept, as they are
+            # about to be registered again
+            if name not in fresh and name not in announced:
+                self.__removeProcessLocally(name)
+        for process in fresh.values():
+            self.__addProcessLocally(process)
+        with self.lock:
+            writer = RendezvousWriter()
+            known = { p['name'] for p in processes }
+            for name in self.withdrawn:
+                if name in known:
+                    writer.writeRemoveProcess({ 'name': name })
+            for name, process in self.announced.items():
+                if name not in fresh:
+                    writer.writeAddProcess(process)
+                elif not RendezvousClient.__sameProcess(fresh[name], process):
+                    # changed while disconnected (the server ignores processes added under a known name)
+                    writer.writeRemoveProcess(process)
+                    writer.writeAddProcess(process)
+            if self.stopped.is_set():
+                self.socket.close()
+                raise ConnectionError('RendezvousClient stopped.')
+            self.__send(writer)
+            self.withdrawn.clear()
+            self.connected.set()
+
+    # Processes (records or dictionaries) are the same if they are written the same way.
+    @staticmethod
+    def __sameProcess(a, b):
+        writerA = RendezvousWriter()
+        writerA.writeAddProcess(a)
+        writerB = RendezvousWriter()
+        writerB.writeAddProcess(b)
+        return writerA.getvalue() == writerB.getvalue()
+
+    def __addProcessLocally(self, process):
+        known = self.registry.process(process['name'])
+        if known is not None and RendezvousClient.__sameProcess(known, process):
+            return
+        process = self.registry.add(process)
+        self.__notify(self.onProcessAdded, process)
+
+    def __removeProcessLocally(self, name):
+        removed = self.registry.remove(name)
+        if removed is not None:
+            self.__notify(self.onProcessRemoved, removed)
+
+    # Invokes a callback, so that an error in the callback does not tear down the connection.
+    def __notify(self, callback, process):
+        if callback is not None:
+            try:
+                callback(process)
+            except Exception:
+                log.exception('Rendezvous callback failed for %r', process)
 
     class Endpoint(IntEnum):
         TcpSource = 0
@@ -88,125 +634,94 @@ class RendezvousClient:
                  'endpoints': endpoints,
                  'version': version }
 
+    # Connects to the server (raising if it cannot be reached), then keeps relaying the process updates
+    # (and reconnecting, unless reconnect is False) on a background thread until stopped.
     def start(self, processAddedCallback = None, processRemovedCallback = None):
-        self.socket.connect(self.serverAddress)
         self.onProcessAdded = processAddedCallback
         self.onProcessRemoved = processRemovedCallback
-        self.__sendProtocolVersion()
-        self.__readProtocolVersion()
-        buf = self.socket.recv(1)
-        len = struct.unpack('B')
-        buf = self.socket.recv(len)
-        addr, = struct.unpack('%ds' % len, buf)
-        self.clientAddress = addr
-        buf = self.socket.recv(4)
-        numProcesses, = struct.unpack('<i', buf)
-        for _ in range(numProcesses):
-            self.__readProcessUpdate()
-        self.thread = threading.Thread(target=self.__readProcessUpdates)
+        self.stopped.clear()
+        self.__establish()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
         self.thread.start()
 
     def stop(self):
-        self.__sendByte(0) # disconnect
-        self.socket.close()
+        self.stopped.set()
+        with self.lock:
+            if self.connected.is_set():
+                self.connected.clear()
+                writer = RendezvousWriter()
+                writer.writeByte(0) # disconnect
+                try:
+                    self.__send(writer)
+                    self.socket.shutdown(socket.SHUT_RDWR) # wakes the update thread up
+                except OSError:
+                    pass
+            if self.socket is not None:
+                self.socket.close()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
 
+    # Announces a process to the server (or, while disconnected, upon reconnection).
     def addProcess(self, process):
-        self.__sendByte(1) # add process
-        self.__sendString(process['name'])
-        self.__sendString(process['version'])
-        self.__sendInt(len(process['endpoints']))
-        for e in process['endpoints']:
-            self.__sendByte(e['endpoint'])
-            if e['endpoint'] == RendezvousClient.Endpoint.TcpSource:
-                self.__sendString(e['host'])
-                self.__sendInt(e['port'])
-            elif e['endpoint'] == RendezvousClient.Endpoint.NetMQSource:
-                self.__sendString(e['address'])
-            elif e['endpoint'] == RendezvousClient.Endpoint.RemoteExporter:
-                self.__sendString(e['host'])
-                self.__sendInt(e['port'])
-                self.__sendInt(e['transport'])
-            elif e['endpoint'] == RendezvousClient.Endpoint.RemoteClockExporter:
-                self.__sendString(e['host'])
-                self.__sendInt(e['port'])
-            else:
-                raise Exception('Unknown type of Endpoint.')
-            self.__sendInt(len(e['streams']))
-            for s in e['streams']:
-                self.__sendString(s['name'])
-                self.__sendString(s['type'])
+        writer = RendezvousWriter()
+        writer.writeAddProcess(process)
+        with self.lock:
+            self.announced[process['name']] = process
+            self.withdrawn.discard(process['name'])
+            self.__trySend(writer)
 
     def removeProcess(self, process):
-        self.__sendByte(2) # remove process
-        self.__sendString(process['name'])
-
-    def __readStreams(self):
-        streams = []
-        count = self.__readInt()
-        for _ in range(count):
-            name = self.__readString()
-            type = self.__readString()
-            streams.append(RendezvousClient.createStream(name, type))
-        return streams
-
-    def __readEndpoint(self):
-        endpoint = RendezvousClient.Endpoint(self.__readByte())
-        if endpoint == RendezvousClient.Endpoint.TcpSource:
-            host = self.__readString()
-            port = self.__readInt()
-            streams = self.__readStreams()
-            return RendezvousClient.createTcpEndpoint(host, port, streams)
-        elif endpoint == RendezvousClient.Endpoint.NetMQSource:
-            address = self.__readString()
-            streams = self.__readStreams()
-            return RendezvousClient.createNetMQEndpoint(address, streams)
-        elif endpoint == RendezvousClient.Endpoint.RemoteExporter:
-            host = self.__readString()
-            port = self.__readInt()
-            transport = RendezvousClient.TransportKind(self.__readInt())
-            streams = self.__readStreams()
-            return RendezvousClient.createRemoteExporterEndpoint(host, port, transport, streams)
-        elif endpoint == RendezvousClient.Endpoint.RemoteClockExporter:
-            host = self.__readString()
-            port = self.__readInt()
-            self.__readInt() # stream count (zero)
-            return RendezvousClient.createRemoteClockExporterEndpoint(host, port)
-        else:
-            raise Exception("Unknown type of Endpoint.")
-
-    def __readProcess(self):
-        name = self.__readString()
-        version = self.__readString()
-        numEndpoints = self.__readInt()
-        endpoints = []
-        for _ in range(numEndpoints):
-            endpoints.append(self.__readEndpoint())
-        return RendezvousClient.createProcess(name, endpoints, version)
-
-    rendezvous = {}
+        writer = RendezvousWriter()
+        writer.writeRemoveProcess(process)
+        with self.lock:
+            announced = self.announced.pop(process['name'], None) is not None
+            if not self.__trySend(writer) and announced:
+                self.withdrawn.add(process['name'])
 
     def __readProcessUpdate(self):
-        update = self.__readByte()
+        update, value = self.__receive(self.incoming.readProcessUpdate)
         if update == 0: # disconnect
             return False
         elif update == 1: # add process
-            process = self.__readProcess()
-            self.rendezvous[process['name']] = process
-            if self.onProcessAdded is not None:
-                self.onProcessAdded(process)
+            self.__addProcessLocally(value)
             return True
-        elif update == 2: # remove process
-            name = self.__readString()
-            removed = self.rendezvous.pop(name)
-            if self.onProcessRemoved is not None:
-                self.onProcessRemoved(removed)
+        else: # remove process
+            self.__removeProcessLocally(value)
             return True
-        else:
-            raise Exception("Unexpected rendezvous action.")
 
     def __readProcessUpdates(self):
         try:
             while self.__readProcessUpdate():
                 pass
-        except: # socket closed?
-            pass
\ No newline at end of file
+        except OSError: # connection lost, or socket closed by stop
+            pass
+        except Exception as e: # corrupt stream
+            log.warning('Unexpected data from RendezvousServer (%s)', e)
+
+    def __run(self):
+        while True:
+            self.__readProcessUpdates()
+            with self.lock:
+                self.connected.clear()
+                self.socket.close()
+            if self.stopped.is_set() or not self.reconnect:
+                return
+            log.warning('Lost the connection to RendezvousServer %s:%d, reconnecting', *self.serverAddress)
+            if not self.__reconnect():
+                return
+
+    # Reconnects with exponential backoff (and jitter, so that the clients of a restarted server do not
+    # all reconnect at once), returning False if stopped first.
+    def __reconnect(self):
+        backoff = self.minBackoff
+        while not self.stopped.wait(backoff * random.uniform(0.5, 1.0)):
+            try:
+                self.__establish()
+                log.info('Reconnected to RendezvousServer %s:%d', *self.serverAddress)
+                return True
+            except Exception as e:
+                if self.stopped.is_set():
+                    break
+                log.debug('Failed to reconnect to RendezvousServer (%s), retrying', e)
+                backoff = min(2 * backoff, self.maxBackoff)
+        return False